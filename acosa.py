@@ -3,20 +3,31 @@
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
 import dataclasses
 import enum
+import hashlib
+import itertools
+import json
 import logging
 import os
 import pathlib
 import re
+import shlex
 import string
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import types
 import typing
 
 import pydantic
 import yaml
 
+import broker
 import colorlog
 
 
@@ -24,6 +35,11 @@ import colorlog
 logger = colorlog.get_logger(__name__, logging.StreamHandler())
 
 ACOSA_DIR = pathlib.Path(__file__).parent
+SCRIPTS_DIR = ACOSA_DIR.joinpath("scripts")
+RUSAGE_SCRIPT = SCRIPTS_DIR.joinpath("rusage.py")
+CACHE_DIR = pathlib.Path(
+    os.getenv("XDG_CACHE_HOME", pathlib.Path.home().joinpath(".cache")), "acosa"
+)
 VARIABLE_RE = re.compile(r"\$\w+")
 
 
@@ -34,23 +50,127 @@ class Variable(pydantic.BaseModel):
     command: bool = False
 
 
+class CommandMemo:
+    """memoized output of the `command: true` variables
+
+    The output is keyed by the expanded command and kept for the whole run,
+    so the same command is executed once even if it is declared by many
+    services. Only the successful commands are memoized. With `ttl` set,
+    the output is also stored in the `root`
+    directory and reused by the next runs while it is not older than `ttl`
+    seconds.
+    """
+
+    def __init__(self, root: pathlib.Path | None = None, ttl: float | None = None) -> None:
+        self.root = root
+        self.ttl = ttl
+
+        self._results: dict[str, str] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, command: str) -> pathlib.Path | None:
+        if self.root is None or self.ttl is None:
+            return None
+        return self.root.joinpath(hashlib.sha256(command.encode()).hexdigest())
+
+    def _load(self, command: str) -> str | None:
+        if (path := self._path(command)) is None:
+            return None
+        try:
+            if time.time() - path.stat().st_mtime < self.ttl:
+                return path.read_text()
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _store(self, command: str, output: str) -> None:
+        if (path := self._path(command)) is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(output)
+        tmp.replace(path)
+
+    def run(self, command: str) -> str:
+        with self._lock:
+            lock = self._locks.setdefault(command, threading.Lock())
+
+        # the same command requested concurrently is executed only once
+        with lock:
+            if (output := self._results.get(command)) is not None:
+                return output
+
+            if (output := self._load(command)) is None:
+                proc = subprocess.run(command, capture_output=True, shell=True)
+                output = proc.stdout.decode()
+
+                # a failure may be transient, the next request runs it again
+                if proc.returncode != 0:
+                    return output
+
+                self._store(command, output)
+
+            self._results[command] = output
+
+        return output
+
+
+COMMAND_MEMO = CommandMemo()
+
+
 @dataclasses.dataclass
 class VariablePool:
     pool: dict[str, Variable]
 
     def add_variable(self, variable: Variable) -> typing.Self:
-        for hit in VARIABLE_RE.findall(variable.value):
-            if (v := self.pool.get(hit)) is None:
-                raise ValueError(f'variable "{hit}" is not set')
+        return self.add_variables([variable])
+
+    def add_variables(self, variables: list[Variable]) -> typing.Self:
+        """resolve the variables and add them to the pool
+
+        A variable depends on the ones it references, so the variables are
+        resolved by waves: the commands of a wave depend only on the
+        previous waves and are executed at the same time.
+        """
+
+        defined: dict[str, int] = {}
+        sources: list[dict[str, int | None]] = []
+        levels: list[int] = []
+
+        for i, variable in enumerate(variables):
+            refs = {}
+            for hit in VARIABLE_RE.findall(variable.value):
+                if (j := defined.get(hit)) is None and hit not in self.pool:
+                    raise ValueError(f'variable "{hit}" is not set')
+                refs[hit] = j
+
+            sources.append(refs)
+            levels.append(max((levels[j] + 1 for j in refs.values() if j is not None), default=0))
+            defined[f"${variable.name}"] = i
+
+        waves: dict[int, list[int]] = {}
+        for i, level in enumerate(levels):
+            waves.setdefault(level, []).append(i)
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for level in sorted(waves):
+                commands = {}
+                for i in waves[level]:
+                    variable = variables[i]
+                    for hit, j in sources[i].items():
+                        value = self.pool[hit].value if j is None else variables[j].value
+                        variable.value = variable.value.replace(hit, value)
 
-            variable.value = variable.value.replace(hit, v.value)
+                    if variable.command:
+                        commands[i] = executor.submit(COMMAND_MEMO.run, variable.value)
 
-        if variable.command:
-            variable.value = subprocess.run(
-                variable.value, capture_output=True, shell=True
-            ).stdout.decode()
+                for i, future in commands.items():
+                    variables[i].value = future.result()
 
-        self.pool[f"${variable.name}"] = variable
+        for variable in variables:
+            self.pool[f"${variable.name}"] = variable
 
         return self
 
@@ -72,7 +192,7 @@ class VariableModel(pydantic.BaseModel):
         if parent is not None:
             self._pool.update(parent)
 
-        [self._pool.add_variable(v) for v in self.variables]
+        self._pool.add_variables(self.variables)
 
         return self
 
@@ -85,11 +205,118 @@ class ServiceApiError(ServiceError):
     pass
 
 
+@dataclasses.dataclass
+class ServiceUsage:
+    """service execution resources, CPU times are in seconds, RSS is in KiB
+
+    The resources are reported by `scripts/rusage.py` for the service and
+    its descendants only (see `Service.run`), `max_rss` is `None` if the
+    report is missing (e.g. the service was killed).
+    """
+
+    start: float
+    wall: float
+    user: float = 0.0
+    system: float = 0.0
+    max_rss: int | None = None
+    in_blocks: int = 0
+    out_blocks: int = 0
+
+    @classmethod
+    def from_rusage(cls, start: float, wall: float, rusage: typing.Any) -> ServiceUsage:
+        return cls(
+            start,
+            wall,
+            rusage.ru_utime,
+            rusage.ru_stime,
+            rusage.ru_maxrss,
+            rusage.ru_inblock,
+            rusage.ru_oublock,
+        )
+
+
 @dataclasses.dataclass
 class ServiceResult:
     service: Service
     content: str
     returncode: int
+    cached: bool = False
+    log: pathlib.Path | None = None
+    usage: ServiceUsage | None = None
+
+
+class OutputCapture:
+    """stream the service output to the log file
+
+    The output is read by large blocks, written to the log file as is and
+    only its last `TAIL_SIZE` bytes are kept in memory for the failure report.
+    """
+
+    BLOCK_SIZE = 1 << 16
+    TAIL_SIZE = 1 << 16
+
+    # serializes the printing of the services running at the same time
+    print_lock = threading.Lock()
+
+    def __init__(self, log: pathlib.Path, echo: bool = False, tag: str | None = None) -> None:
+        self.log = log
+        self.echo = echo
+        self.tag = tag
+
+        self._file = open(log, "wb")
+        self._tail = bytearray()
+        self._truncated = False
+        self._partial = b""
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def __exit__(self, *exc: typing.Any) -> None:
+        self.close()
+
+    def feed(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+
+        self._tail += chunk
+        # trim only when the tail doubled to keep the copying linear
+        if len(self._tail) > 2 * self.TAIL_SIZE:
+            del self._tail[: -self.TAIL_SIZE]
+            self._truncated = True
+
+        if self.echo:
+            self._print(chunk)
+
+    def read_from(self, stream: typing.BinaryIO) -> None:
+        while chunk := stream.read1(self.BLOCK_SIZE):
+            self.feed(chunk)
+
+    def close(self) -> None:
+        if self.echo and self._partial:
+            self._print(b"\n")
+        self._file.close()
+
+    def _print(self, chunk: bytes) -> None:
+        if self.tag is not None:
+            *lines, self._partial = (self._partial + chunk).split(b"\n")
+            if not lines:
+                return
+            prefix = f"[{self.tag}] ".encode()
+            chunk = b"".join(prefix + line + b"\n" for line in lines)
+
+        with self.print_lock:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+
+    @property
+    def tail(self) -> str:
+        tail = bytes(self._tail[-self.TAIL_SIZE :])
+
+        if self._truncated or len(self._tail) > self.TAIL_SIZE:
+            # drop the cut line
+            tail = b"...\n" + tail[tail.find(b"\n") + 1 :]
+
+        return tail.decode(errors="replace")
 
 
 class ServiceName(enum.StrEnum):
@@ -97,6 +324,7 @@ class ServiceName(enum.StrEnum):
     GET_ROOTFS = "get-rootfs.sh"
     CONVERT_ROOTFS = "convert-rootfs.sh"
     BUILD_QCOW2 = "build-qcow2.sh"
+    FLATTEN_QCOW2 = "flatten-qcow2.sh"
     BUILD_ISO = "build-iso.sh"
     CHECKOUT = "checkout.sh"
     APT = "apt.sh"
@@ -108,39 +336,74 @@ class ServiceName(enum.StrEnum):
     FORWARD_ROOT = "forward-root.sh"
     SIGN = "sign.sh"
     COMPRESS = "compress.sh"
+    POSTPROCESS = "postprocess.py"
     ECHO_TEST = "test-echo.sh"
+    STUB_TEST = "test-stub.sh"
     PULL_LOCAL = "pull-local.sh"
 
 
 class Service(VariableModel):
     name: ServiceName
     args: dict[str, str]
+    id: str | None = None
+    depends_on: list[str] | None = None
+    cache: bool = False
+    inputs: list[str] | None = None
+    outputs: list[str] | None = None
     with_print: bool = False
     as_root: bool = False
     skip: bool = False
 
+    def _substitute(self, value: str) -> str:
+        for hit in VARIABLE_RE.findall(value):
+            if (v := self._pool.pool.get(hit)) is None:
+                raise ValueError(f'variable "{hit}" is not set')
+
+            value = value.replace(hit, v.value)
+
+        return value
+
     def unwrap_args(self) -> typing.Self:
         for karg, varg in self.args.items():
-            for hit in VARIABLE_RE.findall(varg):
-                if (v := self._pool.pool.get(hit)) is None:
-                    raise ValueError(f'variable "{hit}" is not set')
+            self.args[karg] = self._substitute(varg)
 
-                varg = varg.replace(hit, v.value)
-
-            self.args[karg] = varg
+        if self.inputs is not None:
+            self.inputs = [self._substitute(value) for value in self.inputs]
+        if self.outputs is not None:
+            self.outputs = [self._substitute(value) for value in self.outputs]
 
         return self
 
-    def _run_proc(self, *args: str, **kwargs: typing.Any) -> subprocess.Popen:
-        """return the service (bash script) process"""
+    def _run_proc(
+        self, *args: str, rusage: pathlib.Path | None = None, **kwargs: typing.Any
+    ) -> subprocess.Popen | broker.BrokerProcess:
+        """return the service (bash script) process
+
+        The root services are started by the privileged broker if it is
+        running (their stderr is always merged into stdout then). With
+        `rusage`, the service resources are written to this file.
+        """
 
-        cur_dir = pathlib.Path(__file__).parent.joinpath("scripts")
-        filename = cur_dir.joinpath(self.name)
+        filename = self.path
 
         args = " ".join(args)
 
         export = self._pool.make_export()
 
+        # the shell execs rusage.py after the service, so the rusage does
+        # not count the RSS of the Python process the shell is forked from
+        launch = ""
+        if rusage is not None:
+            launch = "\nexec " + shlex.join(
+                [sys.executable, "-S", "-I", str(RUSAGE_SCRIPT), str(rusage)]
+            ) + ' "$?"'
+
+        if self.as_root and BROKER is not None:
+            return BROKER.spawn(
+                f"{filename} {args}{launch}",
+                dict(os.environ, PYTHONPATH=str(ACOSA_DIR), **export),
+            )
+
         prefix = ""
         if self.as_root:
             if (password := os.getenv("PASSWORD")) is None:
@@ -149,7 +412,7 @@ class Service(VariableModel):
                 )
             prefix = f"echo {password} | sudo -SE PYTHONPATH={ACOSA_DIR}"
 
-        cmd = f"{prefix} {filename} {args}"
+        cmd = f"{prefix} {filename} {args}{launch}"
         opts = {
             "stdout": subprocess.PIPE,
             "stderr": subprocess.PIPE,
@@ -163,6 +426,11 @@ class Service(VariableModel):
     def api(self) -> string.Template:
         """return the service api template"""
 
+        return API_REGISTRY.get(self)
+
+    def probe_api(self) -> string.Template:
+        """return the service api template printed by the `-a` flag"""
+
         if (proc := self._run_proc("-a")).wait() != 0:
             output = proc.stderr.read().decode().strip("\n")
             raise ServiceApiError(f'failed to get "{self.name}" service API ({output})')
@@ -171,45 +439,678 @@ class Service(VariableModel):
 
         return string.Template(args)
 
-    def run(self, parent: VariablePool) -> ServiceResult:
-        """start the service and return result"""
+    @property
+    def label(self) -> str:
+        return self.id or self.name
+
+    @property
+    def path(self) -> pathlib.Path:
+        return SCRIPTS_DIR.joinpath(self.name)
+
+    def run(
+        self,
+        parent: VariablePool,
+        log: pathlib.Path | None = None,
+        tag: str | None = None,
+        cache: StepCache | None = None,
+    ) -> ServiceResult:
+        """start the service and return result
+
+        The whole output is written to the `log` file (a temporary one by
+        default), the result keeps only its tail.
+        """
 
         api = self.unwrap_vars(parent).unwrap_args().api().substitute(self.args)
-        content = ""
 
-        with self._run_proc(api, stderr=subprocess.STDOUT) as proc:
-            for output in proc.stdout:
-                output = output.decode()
-                # store output to variable for later return
-                content += output
+        if log is None:
+            fd, log = tempfile.mkstemp(prefix=f"acosa-{self.name}-", suffix=".log")
+            os.close(fd)
+            log = pathlib.Path(log)
+
+        start, clock = time.time(), time.monotonic()
+
+        key = None
+        if cache is not None and self.cache:
+            key = cache.key(self, api)
+            if (cached := cache.load(key)) is not None:
+                with OutputCapture(log, self.with_print, tag) as capture, open(cached, "rb") as file:
+                    capture.read_from(file)
+                usage = ServiceUsage(start, time.monotonic() - clock)
+                return ServiceResult(self, capture.tail, 0, cached=True, log=log, usage=usage)
+
+        fd, rusage_file = tempfile.mkstemp(prefix=f"acosa-{self.name}-", suffix=".rusage")
+        os.close(fd)
+        rusage_file = pathlib.Path(rusage_file)
+
+        try:
+            with (
+                OutputCapture(log, self.with_print, tag) as capture,
+                self._run_proc(api, rusage=rusage_file, stderr=subprocess.STDOUT) as proc,
+            ):
+                capture.read_from(proc.stdout)
+                proc.wait()
+
+            try:
+                rusage = types.SimpleNamespace(**json.loads(rusage_file.read_text()))
+                usage = ServiceUsage.from_rusage(start, time.monotonic() - clock, rusage)
+            except (ValueError, TypeError):
+                usage = ServiceUsage(start, time.monotonic() - clock)
+        finally:
+            rusage_file.unlink(missing_ok=True)
 
-                if self.with_print:
-                    print(output, end="")
+        if key is not None and proc.returncode == 0:
+            cache.store(key, log, self.outputs)
 
-        return ServiceResult(self, content, proc.returncode)
+        return ServiceResult(self, capture.tail, proc.returncode, log=log, usage=usage)
+
+
+class ServiceApiRegistry:
+    """in-process cache of the service API templates
+
+    The templates are read from the scripts source (the `-a|--api` branch of
+    the shell services or the `api` string of the python ones), so neither
+    a process nor a sudo round-trip is needed. Only the scripts which do not
+    follow the layout are probed with `-a`. An entry is reloaded as soon as
+    the script modification time or size changes.
+    """
+
+    SHELL_API_RE = re.compile(r'need_api"? -eq 1 \]; then\s+echo -n ([^\n]*)')
+    PYTHON_API_RE = re.compile(r'^\s*api = "([^"]*)"', re.MULTILINE)
+
+    def __init__(self) -> None:
+        self._entries: dict[ServiceName, tuple[tuple[int, int], string.Template]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, path: pathlib.Path) -> string.Template | None:
+        source = path.read_text()
+
+        if (match := cls.SHELL_API_RE.search(source)) is not None:
+            names = re.findall(r"\\\$(\w+)", match.group(1))
+            return string.Template(" ".join(f"${name}" for name in names))
+
+        if (match := cls.PYTHON_API_RE.search(source)) is not None:
+            return string.Template(match.group(1))
+
+        return None
+
+    def get(self, service: Service) -> string.Template:
+        stat = service.path.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if (entry := self._entries.get(service.name)) is not None and entry[0] == stamp:
+                return entry[1]
+
+            if (template := self.parse(service.path)) is None:
+                template = service.probe_api()
+
+            self._entries[service.name] = (stamp, template)
+
+        return template
+
+    def check(self, service: Service) -> None:
+        """make sure that the service args match its API"""
+
+        # a skipped service is never run, e.g. it may be left with old args
+        if service.skip:
+            return
+
+        expected = set(self.get(service).get_identifiers())
+
+        if missing := expected - service.args.keys():
+            raise ServiceApiError(
+                f'service "{service.label}" misses arguments: {", ".join(sorted(missing))}'
+            )
+        if unknown := service.args.keys() - expected:
+            raise ServiceApiError(
+                f'service "{service.label}" got unknown arguments: {", ".join(sorted(unknown))}'
+            )
+
+
+API_REGISTRY = ServiceApiRegistry()
+
+# privileged broker of the root services, started by main()
+BROKER: broker.Broker | None = None
+
+
+@dataclasses.dataclass
+class StepCache:
+    """content-addressed store of the successful service results
+
+    The key covers everything the service consumes: resolved arguments,
+    exported variables, the script itself, the `utils.sh` and `stream.py`
+    used by every service and the declared `inputs`
+    (paths are hashed by content, anything else, e.g. OSTree commit ids,
+    is taken as is).
+
+    The declared `outputs` paths are recorded with the entry
+    (`<key>.outputs`), an entry whose artifacts were removed is a miss.
+    """
+
+    root: pathlib.Path
+
+    BLOCK_SIZE: typing.ClassVar[int] = 1 << 20
+    # sourced or called by every service
+    SHARED_FILES: typing.ClassVar[tuple[pathlib.Path, ...]] = (
+        SCRIPTS_DIR.joinpath("utils.sh"),
+        ACOSA_DIR.joinpath("stream.py"),
+    )
+
+    @classmethod
+    def _hash_file(cls, digest: hashlib._Hash, path: pathlib.Path) -> None:
+        with open(path, "rb") as file:
+            while block := file.read(cls.BLOCK_SIZE):
+                digest.update(block)
+
+    @classmethod
+    def _hash_input(cls, digest: hashlib._Hash, value: str) -> None:
+        path = pathlib.Path(value)
+        digest.update(value.encode())
+
+        if path.is_file():
+            cls._hash_file(digest, path)
+        elif path.is_dir():
+            # the directory trees (e.g. var dirs) are too large to be read
+            # on every run, their metadata is enough to notice a change
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    st = os.lstat(os.path.join(root, name))
+                    digest.update(f"{root}/{name}:{st.st_size}:{st.st_mtime_ns}".encode())
+
+    def key(self, service: Service, api: str) -> str:
+        digest = hashlib.sha256()
+
+        digest.update(
+            json.dumps(
+                [service.name, api, service._pool.make_export(), service.outputs or []],
+                sort_keys=True,
+            ).encode()
+        )
+        self._hash_file(digest, service.path)
+        for path in self.SHARED_FILES:
+            self._hash_file(digest, path)
+        for value in service.inputs or []:
+            self._hash_input(digest, value)
+
+        return digest.hexdigest()
+
+    def load(self, key: str) -> pathlib.Path | None:
+        """return the recorded output log of the service (None if the entry
+        is missing or any of its recorded outputs is gone)"""
+
+        if not (path := self.root.joinpath(key)).exists():
+            return None
+
+        try:
+            outputs = json.loads(self.root.joinpath(f"{key}.outputs").read_text())
+        except FileNotFoundError:
+            outputs = []
+        except ValueError:
+            return None
+
+        if missing := [output for output in outputs if not os.path.lexists(output)]:
+            logger.info(
+                f'cached outputs are missing ({", ".join(missing)}), the service is run again'
+            )
+            return None
+
+        return path
+
+    def store(self, key: str, log: pathlib.Path, outputs: list[str] | None = None) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        # the outputs are written first, so an entry never lacks them
+        tmp = self.root.joinpath(f".{key}.outputs.tmp")
+        tmp.write_text(json.dumps(outputs or []))
+        tmp.replace(self.root.joinpath(f"{key}.outputs"))
+
+        tmp = self.root.joinpath(f".{key}.tmp")
+        shutil.copyfile(log, tmp)
+        tmp.replace(self.root.joinpath(key))
+
+
+class RunReport:
+    """machine-readable record of the services executions
+
+    Every finished service is appended to the `path` file as a JSON line,
+    the `trace` file is written on close in the Chrome trace-event format
+    (chrome://tracing, https://ui.perfetto.dev).
+    """
+
+    def __init__(
+        self, path: pathlib.Path | None = None, trace: pathlib.Path | None = None
+    ) -> None:
+        self.path = path
+        self.trace = trace
+
+        self._records: list[dict[str, typing.Any]] = []
+        self._lock = threading.Lock()
+        self._file = open(path, "a") if path is not None else None
+
+    def add(self, result: ServiceResult, instance: str | None = None) -> None:
+        record = {
+            "instance": instance,
+            "service": result.service.label,
+            "name": str(result.service.name),
+            "returncode": result.returncode,
+            "cached": result.cached,
+            "log": str(result.log) if result.log else None,
+            **dataclasses.asdict(result.usage or ServiceUsage(time.time(), 0.0)),
+        }
+
+        with self._lock:
+            self._records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+
+    def make_trace(self) -> dict[str, typing.Any]:
+        events = []
+        instances: dict[str | None, int] = {}
+        # lane -> end time, a service takes the first lane free at its start
+        lanes: dict[int, list[float]] = {}
+
+        for record in sorted(self._records, key=lambda r: r["start"]):
+            if (pid := instances.get(record["instance"])) is None:
+                pid = instances[record["instance"]] = len(instances)
+                events.append(
+                    {
+                        "name": "process_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "args": {"name": record["instance"] or "acosa"},
+                    }
+                )
+
+            ends = lanes.setdefault(pid, [])
+            tid = next((i for i, end in enumerate(ends) if end <= record["start"]), len(ends))
+            if tid == len(ends):
+                ends.append(0.0)
+            ends[tid] = record["start"] + record["wall"]
+
+            events.append(
+                {
+                    "name": record["service"],
+                    "cat": record["name"],
+                    "ph": "X",
+                    "ts": record["start"] * 1e6,
+                    "dur": record["wall"] * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {
+                        k: record[k]
+                        for k in (
+                            "returncode",
+                            "cached",
+                            "user",
+                            "system",
+                            "max_rss",
+                            "in_blocks",
+                            "out_blocks",
+                            "log",
+                        )
+                    },
+                }
+            )
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+        if self.trace is not None:
+            with open(self.trace, "w") as file:
+                json.dump(self.make_trace(), file)
+
+
+class Journal:
+    """on-disk checkpoint of a config run
+
+    Keeps the resolved task variables and the finished services, so an
+    interrupted run can be resumed from the first unfinished service with
+    exactly the same variables. The journal is removed once the run succeeds.
+    """
+
+    def __init__(self, root: pathlib.Path, key: str) -> None:
+        self.root = root
+        self.key = key
+        self.path = root.joinpath(f"{key}.json")
+
+        self.variables: dict[str, dict[str, typing.Any]] = {}
+        self.done: set[int] = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_config(cls, root: pathlib.Path, config: pathlib.Path, content: str) -> Journal:
+        digest = hashlib.sha256(f"{config.resolve()}\0{content}".encode())
+        return cls(root, digest.hexdigest())
+
+    def instance(self, name: str) -> Journal:
+        """return the journal of the matrix instance"""
+
+        return Journal(self.root, hashlib.sha256(f"{self.key}\0{name}".encode()).hexdigest())
+
+    def load(self) -> bool:
+        try:
+            content = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return False
+
+        self.variables = content["variables"]
+        self.done = set(content["done"])
+
+        return True
+
+    def save(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"variables": self.variables, "done": sorted(self.done)}))
+        tmp.replace(self.path)
+
+    def start(self, pool: VariablePool) -> None:
+        self.variables = {k: v.model_dump() for k, v in pool.pool.items()}
+        self.done = set()
+        self.save()
+
+    def complete(self, index: int) -> None:
+        with self._lock:
+            self.done.add(index)
+            self.save()
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+    @property
+    def pool(self) -> VariablePool:
+        return VariablePool({k: Variable(**v) for k, v in self.variables.items()})
+
+
+class Scheduler:
+    """run the services as soon as their dependencies are finished"""
+
+    def __init__(
+        self,
+        services: list[Service],
+        jobs: int = 1,
+        cache: StepCache | None = None,
+        log_dir: pathlib.Path | None = None,
+        name: str | None = None,
+        report: RunReport | None = None,
+        journal: Journal | None = None,
+    ) -> None:
+        self.services = services
+        self.jobs = jobs
+        self.cache = cache
+        # a temporary log dir is only kept when a service fails
+        self.temporary_log_dir = log_dir is None
+        self.log_dir = log_dir or pathlib.Path(tempfile.mkdtemp(prefix="acosa-"))
+        self.name = name
+        self.report = report
+        self.journal = journal
+        self.graph = self.make_graph(services)
+
+    def _tag(self, service: Service) -> str | None:
+        if self.name is not None:
+            return f"{self.name}/{service.label}"
+        return service.label if self.jobs > 1 else None
+
+    def _log(self, level: int, message: str) -> None:
+        logger.log(level, f"[{self.name}] {message}" if self.name else message)
+
+    @staticmethod
+    def make_graph(services: list[Service]) -> dict[int, set[int]]:
+        """return the service index -> dependency indexes mapping
+
+        A service without `depends_on` depends on the previous one,
+        so the configs without dependencies keep running sequentially.
+        """
+
+        ids: dict[str, int] = {}
+        names: dict[str, list[int]] = {}
+
+        for i, service in enumerate(services):
+            if service.id is not None:
+                if service.id in ids:
+                    raise ValueError(f'service id "{service.id}" is not unique')
+                ids[service.id] = i
+            names.setdefault(service.name, []).append(i)
+
+        graph = {}
+        for i, service in enumerate(services):
+            if service.depends_on is None:
+                graph[i] = {i - 1} if i > 0 else set()
+                continue
+
+            deps = set()
+            for dep in service.depends_on:
+                if (j := ids.get(dep)) is None:
+                    if len(hits := names.get(dep, [])) != 1:
+                        raise ValueError(
+                            f'service "{service.label}" depends on unknown or ambiguous service "{dep}"'
+                        )
+                    j = hits[0]
+                if j == i:
+                    raise ValueError(f'service "{service.label}" depends on itself')
+                deps.add(j)
+            graph[i] = deps
+
+        # Kahn's algorithm, only to make sure that the graph has no cycles
+        pending = {i: len(deps) for i, deps in graph.items()}
+        ready = [i for i, n in pending.items() if n == 0]
+        visited = 0
+        while ready:
+            i = ready.pop()
+            visited += 1
+            for j, deps in graph.items():
+                if i in deps:
+                    pending[j] -= 1
+                    if pending[j] == 0:
+                        ready.append(j)
+
+        if visited != len(graph):
+            raise ValueError("services dependencies contain a cycle")
+
+        return graph
+
+    def run(self, pool: VariablePool) -> ServiceResult | None:
+        """run the services and return the first failed result (if any)
+
+        After a failure no more services are started, the running ones are
+        waited for (root services must not be interrupted in the middle of
+        mount/losetup work).
+        """
+
+        done: set[int] = set(self.journal.done) if self.journal is not None else set()
+        started: set[int] = set(done)
+        for i in sorted(done):
+            self._log(logging.INFO, f'service "{self.services[i].label}" already finished')
+
+        running: dict[concurrent.futures.Future, int] = {}
+        failed = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                while failed is None and (
+                    ready := [
+                        i
+                        for i, deps in self.graph.items()
+                        if i not in started and deps <= done
+                    ]
+                ):
+                    for i in ready:
+                        started.add(i)
+                        service = self.services[i]
+
+                        if service.skip:
+                            done.add(i)
+                            continue
+
+                        self._log(logging.INFO, f'service "{service.label}" started')
+                        log = self.log_dir.joinpath(f"{i:02}-{service.label}.log")
+                        future = executor.submit(
+                            service.run, pool, log, self._tag(service), self.cache
+                        )
+                        running[future] = i
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    i = running.pop(future)
+                    result = future.result()
+
+                    if self.report is not None:
+                        self.report.add(result, self.name)
+
+                    if result.returncode != 0:
+                        self._log(logging.CRITICAL, f'service "{result.service.label}" failed')
+                        failed = failed or result
+                    else:
+                        self._log(
+                            logging.INFO,
+                            f'service "{result.service.label}" finished'
+                            + (" (cached)" if result.cached else "")
+                        )
+                        done.add(i)
+
+                        if self.journal is not None:
+                            self.journal.complete(i)
+
+        if failed is None and self.temporary_log_dir:
+            shutil.rmtree(self.log_dir, ignore_errors=True)
+
+        return failed
 
 
 class Task(VariableModel):
     services: list[Service]
+    matrix: dict[str, list[str]] | None = None
 
-    def run(self) -> None:
-        for service in self.services:
-            if service.skip:
-                continue
+    @pydantic.model_validator(mode="after")
+    def check_graph(self) -> typing.Self:
+        Scheduler.make_graph(self.services)
+        return self
 
-            logger.info(f'service "{service.name}" started')
-            result = service.run(self._pool)
+    def expand(self) -> dict[str, Task]:
+        """return the task instance for each `matrix` values combination
+
+        The matrix values override the task variables of the same name
+        and are available to every other variable.
+        """
+
+        if not self.matrix:
+            return {}
+
+        instances = {}
+        for values in itertools.product(*self.matrix.values()):
+            overrides = dict(zip(self.matrix, values))
+
+            task = self.model_copy(deep=True)
+            task.matrix = None
+            task.variables = [
+                Variable(name=name, value=value) for name, value in overrides.items()
+            ] + [v for v in task.variables or [] if v.name not in overrides]
+
+            instances[",".join(values)] = task
+
+        return instances
+
+    def run(
+        self,
+        jobs: int = 1,
+        cache: StepCache | None = None,
+        log_dir: pathlib.Path | None = None,
+        name: str | None = None,
+        report: RunReport | None = None,
+        journal: Journal | None = None,
+    ) -> ServiceResult | None:
+        """run the services and return the failed service result (if any)"""
+
+        scheduler = Scheduler(
+            self.services, jobs, cache, log_dir, name, report, journal
+        )
+        scheduler._log(
+            logging.INFO,
+            f'services logs are written to "{scheduler.log_dir}"'
+            + (" (removed if all services succeed)" if scheduler.temporary_log_dir else ""),
+        )
+
+        if (result := scheduler.run(self._pool)) is None and journal is not None:
+            journal.remove()
+
+        return result
+
+    def restore_vars(self, journal: Journal | None, resume: bool = False) -> typing.Self:
+        """unwrap the variables or take them from the interrupted run journal"""
+
+        if journal is None:
+            return self.unwrap_vars()
+
+        if resume and journal.load():
+            logger.info(f'resuming the run from "{journal.path}"')
+            self.variables = self.variables or []
+            self._pool = journal.pool
+        else:
+            self.unwrap_vars()
+            journal.start(self._pool)
 
-            if result.returncode != 0:
-                logger.fatal(f'service "{service.name}" failed')
-                print(
-                    f"\nreturncode: {result.returncode}"
-                    f"\n↓ output ↓"
-                    f"\n{result.content}"
-                )
-                sys.exit(1)
-            else:
-                logger.info(f'service "{service.name}" finished')
+        return self
+
+    def run_matrix(
+        self,
+        matrix_jobs: int = 1,
+        jobs: int = 1,
+        cache: StepCache | None = None,
+        log_dir: pathlib.Path | None = None,
+        report: RunReport | None = None,
+        journal: Journal | None = None,
+        resume: bool = False,
+    ) -> dict[str, tuple[ServiceResult | None, float]]:
+        """run the matrix instances, at most `matrix_jobs` at the same time
+
+        Return the instance name -> (failed result, duration) mapping.
+        """
+
+        # a temporary log dir is only kept when an instance fails
+        temporary_log_dir = log_dir is None
+        log_dir = log_dir or pathlib.Path(tempfile.mkdtemp(prefix="acosa-"))
+        logger.info(
+            f'instances logs are written to "{log_dir}"'
+            + (" (removed if all instances succeed)" if temporary_log_dir else "")
+        )
+
+        def run_instance(name: str, task: Task) -> tuple[ServiceResult | None, float]:
+            start = time.monotonic()
+            instance_log_dir = log_dir.joinpath(name.replace("/", "_"))
+            instance_log_dir.mkdir(parents=True, exist_ok=True)
+
+            instance_journal = journal.instance(name) if journal is not None else None
+
+            result = task.restore_vars(instance_journal, resume).run(
+                jobs, cache, instance_log_dir, name, report, instance_journal
+            )
+
+            return result, time.monotonic() - start
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=matrix_jobs) as executor:
+            futures = {
+                name: executor.submit(run_instance, name, task)
+                for name, task in self.expand().items()
+            }
+
+        summary = {name: future.result() for name, future in futures.items()}
+
+        if temporary_log_dir and all(result is None for result, _ in summary.values()):
+            shutil.rmtree(log_dir, ignore_errors=True)
+
+        return summary
 
     def check_sudo(self) -> typing.Self:
         for service in self.services:
@@ -220,23 +1121,156 @@ class Task(VariableModel):
                     )
         return self
 
+    def check_api(self) -> typing.Self:
+        for service in self.services:
+            API_REGISTRY.check(service)
+        return self
+
+
+def report(result: ServiceResult) -> None:
+    print(
+        f"\nreturncode: {result.returncode}"
+        f"\nlog: {result.log}"
+        f"\n↓ output ↓"
+        f"\n{result.content}"
+    )
+
+
+def report_matrix(summary: dict[str, tuple[ServiceResult | None, float]]) -> None:
+    width = max(map(len, summary))
+
+    print("\nmatrix summary:")
+    for name, (result, duration) in summary.items():
+        status = "ok" if result is None else f'failed ({result.service.label})'
+        print(f"  {name:<{width}}  {duration:8.1f}s  {status}")
+
+    for name, (result, _) in summary.items():
+        if result is not None:
+            print(f"\n[{name}] service \"{result.service.label}\" failed", end="")
+            report(result)
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="ALT Container OS Assembler")
     parser.add_argument("config", help="ALTCOS yaml config")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Maximum number of services running at the same time",
+    )
+    parser.add_argument(
+        "-m",
+        "--matrix-jobs",
+        type=int,
+        default=1,
+        help="Maximum number of matrix instances running at the same time",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Skip the services with \"cache: true\" whose inputs are unchanged",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=CACHE_DIR,
+        help="Service results cache directory",
+    )
+    parser.add_argument(
+        "--command-ttl",
+        type=float,
+        help="Reuse the command variables output of previous runs for this many seconds",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=pathlib.Path,
+        help="Services output directory (a temporary one by default, removed after a successful run)",
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        help="Append the services resources usage to this JSON lines file",
+    )
+    parser.add_argument(
+        "--trace",
+        type=pathlib.Path,
+        help="Write the services timeline to this Chrome trace-event file",
+    )
+    parser.add_argument(
+        "--no-broker",
+        action="store_true",
+        help="Run every root service through its own sudo call",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the interrupted run of the config from the first unfinished service",
+    )
 
     args = parser.parse_args()
 
     try:
         with open(args.config, "r") as file:
-            content = yaml.safe_load(file)
+            source = file.read()
+        content = yaml.safe_load(source)
     except (OSError, yaml.scanner.ScannerError) as e:
         logger.fatal(f'failed to read "{args.config}"\n{e}')
         sys.exit(1)
 
+    cache = StepCache(args.cache_dir) if args.cache else None
+    if args.command_ttl is not None:
+        COMMAND_MEMO.root = args.cache_dir.joinpath("commands")
+        COMMAND_MEMO.ttl = args.command_ttl
+    if args.log_dir is not None:
+        args.log_dir.mkdir(parents=True, exist_ok=True)
+
+    journal = Journal.for_config(
+        args.cache_dir.joinpath("journal"), pathlib.Path(args.config), source
+    )
+
+    run_report = None
+    if args.report is not None or args.trace is not None:
+        run_report = RunReport(args.report, args.trace)
+
+    global BROKER
+
     try:
-        Task.model_validate(content).check_sudo().unwrap_vars().run()
-    except (ServiceError, pydantic.ValidationError) as e:
+        task = Task.model_validate(content).check_sudo()
+
+        if not args.no_broker and any(s.as_root and not s.skip for s in task.services):
+            BROKER = broker.Broker.start(os.environ["PASSWORD"], ACOSA_DIR)
+
+        task.check_api()
+
+        if task.matrix:
+            summary = task.run_matrix(
+                args.matrix_jobs,
+                args.jobs,
+                cache,
+                args.log_dir,
+                run_report,
+                journal,
+                args.resume,
+            )
+            report_matrix(summary)
+            if any(result is not None for result, _ in summary.values()):
+                sys.exit(1)
+        elif (
+            result := task.restore_vars(journal, args.resume).run(
+                args.jobs, cache, args.log_dir, report=run_report, journal=journal
+            )
+        ) is not None:
+            report(result)
+            sys.exit(1)
+    except (ServiceError, broker.BrokerError, pydantic.ValidationError) as e:
         logger.fatal(e)
+    finally:
+        if run_report is not None:
+            run_report.close()
+        if BROKER is not None:
+            BROKER.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""acosa.py orchestration benchmarks
+
+Runs `Task` against the `test-stub.sh` service and reports the time acosa.py
+itself spends around the services (config validation, variable
+substitution, API lookup, scheduling, output capture), so the changes of
+`Service.run`, `VariablePool` and the scheduler can be measured.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+import acosa
+import colorlog
+
+logger = colorlog.get_logger(__name__, logging.StreamHandler(), fmt="%(message)s")
+
+STUB = acosa.ServiceName.STUB_TEST
+
+
+def make_config(
+    services: int,
+    lines: int,
+    width: int,
+    sleep: float,
+    depth: int,
+    commands: int,
+) -> dict[str, typing.Any]:
+    """return an acosa config with `services` stubs
+
+    Every stub argument goes through a chain of `depth` variables and
+    `commands` independent command variables.
+    """
+
+    variables = [{"name": "v0", "value": str(lines)}]
+    variables += [{"name": f"v{i}", "value": f"$v{i - 1}"} for i in range(1, depth + 1)]
+    variables += [
+        {"name": f"c{i}", "value": f"echo -n {i}", "command": True} for i in range(commands)
+    ]
+
+    return {
+        "variables": variables,
+        "services": [
+            {
+                "name": STUB.value,
+                "args": {"lines": f"$v{depth}", "width": str(width), "sleep": str(sleep)},
+            }
+            for _ in range(services)
+        ],
+    }
+
+
+def run_task(config: dict[str, typing.Any], jobs: int) -> dict[str, float]:
+    """run the config and return the duration of each acosa phase"""
+
+    phases = {}
+
+    # a warm memo would skip the commands of every sample after the first
+    acosa.COMMAND_MEMO = acosa.CommandMemo()
+
+    start = time.perf_counter()
+    task = acosa.Task.model_validate(config)
+    phases["validate"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    task.check_api()
+    phases["api"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    task.unwrap_vars()
+    phases["variables"] = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory(prefix="acosa-bench-") as log_dir:
+        start = time.perf_counter()
+        result = task.run(jobs, log_dir=pathlib.Path(log_dir))
+        phases["run"] = time.perf_counter() - start
+
+    if result is not None:
+        logger.fatal(f"stub service failed:\n{result.content}")
+        sys.exit(1)
+
+    phases["total"] = sum(phases.values())
+
+    return phases
+
+
+def run_direct(count: int, lines: int, width: int, sleep: float) -> float:
+    """return the time of running the stub `count` times without acosa"""
+
+    cmd = [str(acosa.SCRIPTS_DIR.joinpath(STUB)), str(lines), str(width), str(sleep)]
+
+    start = time.perf_counter()
+    for _ in range(count):
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+
+    return time.perf_counter() - start
+
+
+def median(samples: list[dict[str, float]]) -> dict[str, float]:
+    return {k: statistics.median(s[k] for s in samples) for k in samples[0]}
+
+
+def bench_overhead(args: argparse.Namespace) -> dict[str, float]:
+    config = make_config(args.services, 0, 0, 0, args.depth, args.commands)
+
+    samples = []
+    for _ in range(args.repeat):
+        phases = run_task(config, args.jobs)
+        phases["direct"] = run_direct(args.services, 0, 0, 0)
+        samples.append(phases)
+
+    result = median(samples)
+    result["per_service_ms"] = (result["total"] - result["direct"]) / args.services * 1e3
+
+    return result
+
+
+def bench_capture(args: argparse.Namespace) -> dict[str, float]:
+    config = make_config(1, args.capture_lines, args.width, 0, 0, 0)
+    size = args.capture_lines * (args.width + 1)
+
+    samples = []
+    for _ in range(args.repeat):
+        phases = run_task(config, 1)
+        phases["direct"] = run_direct(1, args.capture_lines, args.width, 0)
+        samples.append(phases)
+
+    result = median(samples)
+    result["throughput_mib_s"] = size / result["run"] / (1 << 20)
+    result["direct_mib_s"] = size / result["direct"] / (1 << 20)
+
+    return result
+
+
+# metric -> True if a greater value is better
+GUARDED = {
+    ("overhead", "per_service_ms"): False,
+    ("capture", "throughput_mib_s"): True,
+}
+
+
+def check_regressions(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    regressions = []
+
+    for (scenario, metric), greater_better in GUARDED.items():
+        if (old := baseline.get(scenario, {}).get(metric)) is None:
+            continue
+
+        new = results[scenario][metric]
+        change = (new - old) / old * 100 if old else 0.0
+        if (-change if greater_better else change) > tolerance:
+            regressions.append(f"{scenario}.{metric}: {old:.3f} -> {new:.3f} ({change:+.1f}%)")
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="acosa.py orchestration benchmarks")
+    parser.add_argument("-s", "--services", type=int, default=50, help="Stub services count")
+    parser.add_argument("-d", "--depth", type=int, default=20, help="Variables chain depth")
+    parser.add_argument("-c", "--commands", type=int, default=10, help="Command variables count")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Scheduler jobs")
+    parser.add_argument(
+        "-l", "--capture-lines", type=int, default=500000, help="Output lines of the capture scenario"
+    )
+    parser.add_argument("-w", "--width", type=int, default=80, help="Output line width")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per scenario (median is taken)")
+    parser.add_argument("--save", type=pathlib.Path, help="Save the results as a baseline")
+    parser.add_argument("--baseline", type=pathlib.Path, help="Fail on regressions against this baseline")
+    parser.add_argument(
+        "-t", "--tolerance", type=float, default=10.0, help="Allowed regression in percent"
+    )
+
+    args = parser.parse_args()
+
+    acosa.logger.setLevel(logging.WARNING)
+
+    results = {"overhead": bench_overhead(args), "capture": bench_capture(args)}
+
+    for scenario, metrics in results.items():
+        print(f"{scenario}:")
+        for metric, value in metrics.items():
+            print(f"  {metric:<18} {value:10.3f}")
+
+    if args.save is not None:
+        args.save.write_text(json.dumps(results, indent=2))
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        if regressions := check_regressions(results, baseline, args.tolerance):
+            logger.fatal("regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""Privileged execution broker
+
+The broker is started once with sudo and launches the root services on
+request over a local UNIX socket, streaming their output back. This way the
+whole run uses one privilege session instead of a sudo/PAM round-trip (and
+a password on the command line) per service.
+
+Frames are `<type:1><length:4><payload>`: "o" carries the process output,
+"x" closes the stream with the JSON encoded return code.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import pathlib
+import select
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import typing
+
+BLOCK_SIZE = 1 << 16
+HEADER = struct.Struct("!cI")
+START_TIMEOUT = 60
+PEERCRED = struct.Struct("3i")
+OUTPUT, EXIT = b"o", b"x"
+
+
+class BrokerError(Exception):
+    pass
+
+
+def send_frame(sock: socket.socket, kind: bytes, payload: bytes) -> None:
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+
+def recv_exact(file: typing.BinaryIO, size: int) -> bytes:
+    data = file.read(size)
+    if len(data) != size:
+        raise BrokerError("broker connection closed unexpectedly")
+    return data
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        # the commands run as root, serve only the user who started us
+        _, uid, _ = PEERCRED.unpack(
+            self.connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+        )
+        if uid not in (self.server.uid, 0):
+            return
+
+        request = json.loads(self.rfile.readline())
+
+        # keep the broker PATH like sudo does with secure_path
+        env = dict(request["env"], PATH=os.environ.get("PATH", os.defpath))
+
+        with subprocess.Popen(
+            request["cmd"],
+            shell=True,
+            cwd=request["cwd"],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        ) as proc:
+            try:
+                while chunk := proc.stdout.read1(BLOCK_SIZE):
+                    send_frame(self.connection, OUTPUT, chunk)
+            except OSError:
+                # the client has gone, do not leave the service behind
+                proc.kill()
+
+            proc.wait()
+
+        result = {"returncode": proc.returncode}
+        try:
+            send_frame(self.connection, EXIT, json.dumps(result).encode())
+        except OSError:
+            pass
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, uid: int) -> None:
+        super().__init__(path, RequestHandler)
+        self.uid = uid
+
+
+def serve(path: pathlib.Path, uid: int) -> None:
+    """serve until the parent closes our stdin"""
+
+    with Server(str(path), uid) as server:
+        os.chown(path, uid, -1)
+        os.chmod(path, 0o600)
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        print("ready", flush=True)
+        sys.stdin.read()
+
+        server.shutdown()
+
+
+class BrokerProcess:
+    """service process started by the broker
+
+    Provides the subset of `subprocess.Popen` used by the services:
+    `stdout.read1()`/`stdout.read()`, `stderr`, `wait()` and `returncode`.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self._sock = sock
+        self._file = sock.makefile("rb")
+        self._buffer = bytearray()
+
+        self.returncode: int | None = None
+
+        self.stdout = self
+        self.stderr = self
+
+    def __enter__(self) -> typing.Self:
+        return self
+
+    def __exit__(self, *exc: typing.Any) -> None:
+        self.close()
+
+    def _read_frame(self) -> None:
+        kind, size = HEADER.unpack(recv_exact(self._file, HEADER.size))
+        payload = recv_exact(self._file, size)
+
+        if kind == OUTPUT:
+            self._buffer += payload
+        elif kind == EXIT:
+            result = json.loads(payload)
+            self.returncode = result["returncode"]
+        else:
+            raise BrokerError(f"unknown frame {kind!r}")
+
+    def read1(self, size: int = BLOCK_SIZE) -> bytes:
+        while not self._buffer and self.returncode is None:
+            self._read_frame()
+
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        return chunk
+
+    def read(self) -> bytes:
+        self.wait()
+
+        content = bytes(self._buffer)
+        self._buffer.clear()
+
+        return content
+
+    def wait(self) -> int:
+        while self.returncode is None:
+            self._read_frame()
+        return self.returncode
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+
+class Broker:
+    """client of the privileged broker process"""
+
+    def __init__(self, proc: subprocess.Popen, path: pathlib.Path) -> None:
+        self.proc = proc
+        self.path = path
+
+    @classmethod
+    def start(cls, password: str, pythonpath: str | os.PathLike) -> Broker:
+        """authenticate with sudo once and start the broker"""
+
+        # a wrong password would make sudo prompt again on the stdin kept
+        # open for the broker, so the credentials are checked first
+        try:
+            check = subprocess.run(
+                ["sudo", "-S", "-v", "-p", ""],
+                input=f"{password}\n".encode(),
+                capture_output=True,
+                timeout=START_TIMEOUT,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise BrokerError(f"failed to check the sudo credentials ({e})") from None
+        if check.returncode != 0:
+            raise BrokerError(
+                f"failed to check the sudo credentials ({check.stderr.decode().strip()})"
+            )
+
+        path = pathlib.Path(tempfile.mkdtemp(prefix="acosa-broker-"), "socket")
+        log = path.with_name("broker.log")
+
+        try:
+            # the broker stderr is never read, a pipe could fill up and block it
+            with open(log, "wb") as stderr:
+                proc = subprocess.Popen(
+                    [
+                        "sudo",
+                        "-S",
+                        "-E",
+                        "-p",
+                        "",
+                        f"PYTHONPATH={pythonpath}",
+                        sys.executable,
+                        __file__,
+                        str(path),
+                        str(os.getuid()),
+                    ],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=stderr,
+                )
+        except OSError as e:
+            log.unlink(missing_ok=True)
+            path.parent.rmdir()
+            raise BrokerError(f"failed to start the privileged broker ({e})") from None
+
+        # sudo consumes the first line, the rest of stdin is kept open for
+        # the broker: it exits as soon as we close it
+        try:
+            proc.stdin.write(f"{password}\n".encode())
+            proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+        ready, _, _ = select.select([proc.stdout], [], [], START_TIMEOUT)
+        if not ready or proc.stdout.readline().strip() != b"ready":
+            proc.kill()
+            proc.stdin.close()
+            proc.wait()
+            error = log.read_text(errors="replace").strip()
+            log.unlink(missing_ok=True)
+            path.parent.rmdir()
+            raise BrokerError(f"failed to start the privileged broker ({error})")
+
+        return cls(proc, path)
+
+    def spawn(self, cmd: str, env: dict[str, str], cwd: str | None = None) -> BrokerProcess:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(str(self.path))
+
+        request = {"cmd": cmd, "env": env, "cwd": cwd or os.getcwd()}
+        sock.sendall(json.dumps(request).encode() + b"\n")
+
+        return BrokerProcess(sock)
+
+    def stop(self) -> None:
+        self.proc.stdin.close()
+        self.proc.wait()
+
+        try:
+            self.path.unlink(missing_ok=True)
+            self.path.with_name("broker.log").unlink(missing_ok=True)
+            self.path.parent.rmdir()
+        except OSError:
+            pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ALTCOS privileged execution broker")
+    parser.add_argument("socket", type=pathlib.Path, help="UNIX socket path")
+    parser.add_argument("uid", type=int, help="the only user allowed to connect")
+
+    args = parser.parse_args()
+
+    serve(args.socket, args.uid)
+
+
+if __name__ == "__main__":
+    main()
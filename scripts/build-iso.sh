@@ -45,26 +45,13 @@ format=iso
 apt_dir="$HOME"/apt
 
 check_args stream repo_root mode storage commit
-check_stream "$stream" "$repo_root"
 
-export_stream "$stream" "$repo_root" "$mode"
+describe_stream "$stream" "$repo_root" "$mode" "$commit"
+require_envs COMMIT
 
-commit="$(get_commit "$stream" "$repo_root" "$mode" "$commit" "$mkimage_root")"
-
-version="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    --mode "$mode" \
-    version \
-    --commit "$commit")"
-
-version_path="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    --mode "$mode" \
-    version \
-    --commit "$commit" \
-    --view path)"
+commit="$COMMIT"
+version="$VERSION"
+version_path="$VERSION_PATH"
 
 commit_dir="$VARS_DIR"/"$version_path"/var
 
@@ -81,9 +68,6 @@ sudo chmod -R 777 "$build_dir"
 
 image_file="$build_dir"/"$BRANCH"_"$NAME"."$ARCH"."$version"."$platform"."$format"
 
-rpmbuild_dir="$(mktemp --tmpdir -d "$(basename "$0")"_rpmbuild-XXXXXX)"
-mkdir "$rpmbuild_dir"/SOURCES
-
 cur_dir="$(pwd)"
 cd "$__dir"/specs/startup-installer-altcos
 # shellcheck disable=SC2153
@@ -94,33 +78,103 @@ gear-rpm \
     --define "_rpmfilename startup-installer-altcos-0.2.4-alt1.x86_64.rpm"
 cd "$cur_dir"
 
-sudo tar -cf - \
-    -C "$(dirname "$commit_dir")" var \
-    | xz -9 -c -T0 --memlimit=2048MiB - > "$rpmbuild_dir"/SOURCES/var.tar.xz
+# the installer unpacks *.tar.xz, so only the xz level may be changed
+payload_compress="$(python3 "$__dir"/compression.py command --suffix .xz "${COMPRESSION_PAYLOAD:-xz:9}")"
+
+# the payload archives and the altcos-archives RPM are cached next to the
+# stream vars and reused while the var dir, the stream ref and the
+# compression stay the same (an empty file, as left by an interrupted
+# build, is not an entry)
+cache_dir="$(dirname "$VARS_DIR")"/cache/iso
+payload_root="$cache_dir"/altcos_root
 
-mkdir "$rpmbuild_dir"/altcos_root
+sudo mkdir -p "$cache_dir"
+sudo chmod 777 "$cache_dir"
 
-ostree admin init-fs \
-    --modern "$rpmbuild_dir"/altcos_root
+# one build of the stream uses the cache at a time
+exec {cache_lock}>"$cache_dir"/.lock
+flock "$cache_lock"
 
 ostree_dir="$(get_ostree_dir "$stream" "$repo_root" "$mode")"
-sudo ostree \
-    pull-local \
-    --repo "$rpmbuild_dir"/altcos_root/ostree/repo \
-    "$ostree_dir" \
-    "$STREAM"
-
-sudo tar -cf - -C "$rpmbuild_dir"/altcos_root . \
-    | xz -9 -c -T0 --memlimit=2048MiB - > "$rpmbuild_dir"/SOURCES/altcos_root.tar.xz
-sudo rm -rf "$rpmbuild_dir"/altcos_root
-
-rpmbuild \
-    --define "_topdir $rpmbuild_dir" \
-    --define "_rpmdir $apt_dir/$ARCH/RPMS.dir/" \
-    --define "_rpmfilename altcos-archives-0.1-alt1.x86_64.rpm" \
-    -bb "$__dir"/specs/altcos-archives.spec
+payload_commit="$(sudo ostree rev-parse --repo "$ostree_dir" "$STREAM")"
+
+# the var dir is identified by its listing (path, size, mtime, mode, owner
+# and link target), so it is not read entirely
+var_sum="$(sudo find "$commit_dir" -printf '%P\t%s\t%T@\t%m\t%U:%G\t%l\n' \
+    | LC_ALL=C sort \
+    | sha256sum \
+    | cut -d' ' -f1)"
+compress_sum="$(echo "$payload_compress" | sha256sum | cut -c1-16)"
+archives_sum="$( {
+    echo "$var_sum" "$payload_commit" "$compress_sum"
+    cat "$__dir"/specs/altcos-archives.spec
+} | sha256sum | cut -d' ' -f1)"
+
+var_archive="$cache_dir"/var-"$var_sum"-"$compress_sum".tar.xz
+root_archive="$cache_dir"/altcos_root-"$payload_commit"-"$compress_sum".tar.xz
+archives_rpm="$cache_dir"/altcos-archives-"$archives_sum".rpm
+
+if [ ! -s "$archives_rpm" ]; then
+    if [ ! -s "$var_archive" ]; then
+        # shellcheck disable=SC2086
+        sudo tar -cf - \
+            -C "$(dirname "$commit_dir")" var \
+            | $payload_compress - > "$var_archive".tmp
+        mv "$var_archive".tmp "$var_archive"
+    fi
+
+    if [ ! -s "$root_archive" ]; then
+        if [ ! -d "$payload_root"/ostree/repo ]; then
+            sudo ostree admin init-fs \
+                --modern "$payload_root"
+        fi
+
+        # only the objects missing from the previous payload are pulled
+        sudo ostree \
+            pull-local \
+            --repo "$payload_root"/ostree/repo \
+            "$ostree_dir" \
+            "$STREAM"
+
+        # leave only the pulled commit, as in a fresh repository
+        sudo ostree prune \
+            --repo "$payload_root"/ostree/repo \
+            --refs-only \
+            --depth=0
+
+        # shellcheck disable=SC2086
+        sudo tar -cf - -C "$payload_root" . \
+            | $payload_compress - > "$root_archive".tmp
+        mv "$root_archive".tmp "$root_archive"
+    fi
+
+    rpmbuild_dir="$(mktemp --tmpdir -d "$(basename "$0")"_rpmbuild-XXXXXX)"
+    mkdir "$rpmbuild_dir"/SOURCES
+    ln -s "$var_archive" "$rpmbuild_dir"/SOURCES/var.tar.xz
+    ln -s "$root_archive" "$rpmbuild_dir"/SOURCES/altcos_root.tar.xz
+
+    rpmbuild \
+        --define "_topdir $rpmbuild_dir" \
+        --define "_rpmdir $rpmbuild_dir/RPMS" \
+        --define "_rpmfilename altcos-archives.rpm" \
+        -bb "$__dir"/specs/altcos-archives.spec
+
+    mv "$rpmbuild_dir"/RPMS/altcos-archives.rpm "$archives_rpm"
+    sudo rm -rf "$rpmbuild_dir"
+fi
 
-sudo rm -rf "$rpmbuild_dir"
+cp "$archives_rpm" "$apt_dir"/"$ARCH"/RPMS.dir/altcos-archives-0.1-alt1.x86_64.rpm
+
+# the entries unused for ISO_CACHE_DAYS (14 by default) are removed; the
+# archives are not made again when the RPM is cached, so a missing one is
+# not created empty here
+touch -c "$var_archive" "$root_archive" "$archives_rpm"
+find "$cache_dir" \
+    -maxdepth 1 \
+    -type f \
+    \( -name '*.tar.xz' -o -name '*.rpm' \) \
+    -mtime +"${ISO_CACHE_DAYS:-14}" \
+    -delete
 
 sudo chmod a+w "$build_dir"
 
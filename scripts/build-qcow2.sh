@@ -50,27 +50,13 @@ if efibootmgr; then
 fi
 
 check_args stream repo_root mode storage commit
-check_stream "$stream" "$repo_root"
 
-export_stream "$stream" "$repo_root" "$mode"
-
-commit="$(get_commit "$stream" "$repo_root" "$mode" "$commit")"
-
-version="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    --mode "$mode" \
-    version \
-    --commit "$commit")"
-
-version_path="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    --mode "$mode" \
-    version \
-    --commit "$commit" \
-    --view path)"
+describe_stream "$stream" "$repo_root" "$mode" "$commit"
+require_envs COMMIT
 
+commit="$COMMIT"
+version="$VERSION"
+version_path="$VERSION_PATH"
 
 commit_dir="$VARS_DIR"/"$version_path"/var
 
@@ -86,85 +72,160 @@ mkdir -p "$build_dir"
 
 image_file="$build_dir"/"$BRANCH"_"$NAME"."$ARCH"."$version"."$platform"."$format"
 
-mount_dir=$(mktemp --tmpdir -d "$(basename "$0")"-XXXXXX)
+# QCOW2_INCREMENTAL=1 makes a thin overlay over the image of the parent
+# commit: only the new ostree objects, the deployment and var are written
+parent_image=
+if [ "${QCOW2_INCREMENTAL:-0}" -eq 1 ] && [ -n "$PARENT_COMMIT" ]; then
+    # the parent of the first commit of a derived stream is not in its repository
+    parent_version="$(describe_stream "$stream" "$repo_root" "$mode" "$PARENT_COMMIT" 2>/dev/null \
+        && echo "$VERSION")" || parent_version=none
+    parent_image="$build_dir"/../../../"$parent_version"/"$platform"/"$format"/"$BRANCH"_"$NAME"."$ARCH"."$parent_version"."$platform"."$format"
+
+    if [ -f "$parent_image" ]; then
+        parent_image="$(realpath "$parent_image")"
+    else
+        echo "parent image \"$parent_image\" does not exist, build the full image" >&2
+        parent_image=
+    fi
+fi
+
+mount_dir=
+block_dev=
+raw_file=
+
+# unmount and detach the image, a failed build also removes it
+cleanup() {
+    local status=$?
+
+    if [ -n "$mount_dir" ]; then
+        if mountpoint -q "$mount_dir"; then
+            umount -R "$mount_dir"
+        fi
+        rmdir "$mount_dir"
+    fi
+
+    if [ -n "$raw_file" ]; then
+        if [ -n "$block_dev" ]; then
+            losetup -d "$block_dev"
+        fi
+        rm -f "$raw_file"
+    elif [ -n "$block_dev" ]; then
+        qemu-nbd --disconnect "$block_dev" >/dev/null
+    fi
+
+    if [ "$status" -ne 0 ]; then
+        rm -f "$image_file"
+    fi
+}
+trap cleanup EXIT
 
-raw_file=$(mktemp --tmpdir "$(basename "$0")"-XXXXXX.raw)
+mount_dir=$(mktemp --tmpdir -d "$(basename "$0")"-XXXXXX)
 
 mount_dir_repo="$mount_dir/ostree/repo"
 mount_dir_efi="$mount_dir/boot/efi"
 
-fallocate -l "$root_size" "$raw_file"
-
-loop_dev=$(losetup --show -f "$raw_file")
-efi_part="$loop_dev"p1
-root_part="$loop_dev"p3
-
-parted "$loop_dev" mktable gpt
-parted -a optimal "$loop_dev" mkpart primary fat32 1MIB 256MIB
-parted -a optimal "$loop_dev" mkpart primary fat32 256MIB 257MIB
-parted -a optimal "$loop_dev" mkpart primary ext4 257MIB 100%
-
-mkfs.fat -F32 "$efi_part"
-mkfs.ext4 -L boot "$root_part"
+# the image is written in place through nbd, the raw file and its full
+# conversion copy are left only as a fallback when nbd is not available
+if [ -n "$parent_image" ]; then
+    qemu-img create -q -f qcow2 -F qcow2 -b "$parent_image" "$image_file"
+    block_dev="$(attach_qcow2 "$image_file")" || {
+        fatal "failed to attach \"$image_file\", nbd is required for the incremental build"
+        exit 1
+    }
+elif qemu-img create -q -f qcow2 "$image_file" "$root_size" \
+        && block_dev="$(attach_qcow2 "$image_file")"; then
+    :
+else
+    rm -f "$image_file"
+    raw_file=$(mktemp --tmpdir "$(basename "$0")"-XXXXXX.raw)
+    fallocate -l "$root_size" "$raw_file"
+    block_dev=$(losetup --show -f "$raw_file")
+fi
 
-# ef02 - BIOS
-# 8304 - root
-sgdisk \
-    --typecode 2:ef02 \
-    --typecode 3:8304 \
-    --change-name 3:boot \
-    --change-name 1:EFI \
-    "$loop_dev"
-partprobe "$loop_dev"
+efi_part="$block_dev"p1
+root_part="$block_dev"p3
+
+if [ -z "$parent_image" ]; then
+    parted "$block_dev" mktable gpt
+    parted -a optimal "$block_dev" mkpart primary fat32 1MIB 256MIB
+    parted -a optimal "$block_dev" mkpart primary fat32 256MIB 257MIB
+    parted -a optimal "$block_dev" mkpart primary ext4 257MIB 100%
+
+    mkfs.fat -F32 "$efi_part"
+    mkfs.ext4 -L boot "$root_part"
+
+    # ef02 - BIOS
+    # 8304 - root
+    sgdisk \
+        --typecode 2:ef02 \
+        --typecode 3:8304 \
+        --change-name 3:boot \
+        --change-name 1:EFI \
+        "$block_dev"
+fi
+partprobe "$block_dev"
 
 mount "$root_part" "$mount_dir"
 mkdir -p "$mount_dir_efi"
 mount "$efi_part"  "$mount_dir_efi"
 
-ostree admin \
-    init-fs \
-    --modern "$mount_dir"
+if [ -z "$parent_image" ]; then
+    ostree admin \
+        init-fs \
+        --modern "$mount_dir"
+fi
 
 ostree_dir="$(get_ostree_dir "$stream" "$repo_root" "$mode")"
 
+# the overlay repository already has the objects of the parent commit
 ostree pull-local \
     --repo "$mount_dir_repo" \
     "$ostree_dir" \
     "$commit"
 
-grub-install \
-    --target=i386-pc \
-    --root-directory="$mount_dir" \
-    "$loop_dev"
-
-if [ "$efi_support" -eq 1 ]; then
+if [ -z "$parent_image" ]; then
     grub-install \
-        --target=x86_64-efi \
+        --target=i386-pc \
         --root-directory="$mount_dir" \
-        --efi-directory="$mount_dir_efi"
-fi
+        "$block_dev"
 
-ln -s ../loader/grub.cfg "$mount_dir"/boot/grub/grub.cfg
+    if [ "$efi_support" -eq 1 ]; then
+        grub-install \
+            --target=x86_64-efi \
+            --root-directory="$mount_dir" \
+            --efi-directory="$mount_dir_efi"
+    fi
 
-ostree config \
-    --repo "$mount_dir_repo" \
-    set sysroot.bootloader grub2
+    ln -s ../loader/grub.cfg "$mount_dir"/boot/grub/grub.cfg
 
-ostree config \
-    --repo "$mount_dir_repo" \
-    set sysroot.readonly true
+    ostree config \
+        --repo "$mount_dir_repo" \
+        set sysroot.bootloader grub2
+
+    ostree config \
+        --repo "$mount_dir_repo" \
+        set sysroot.readonly true
+fi
 
 # shellcheck disable=SC2153
 ostree refs \
     --repo "$mount_dir_repo" \
+    --force \
     --create altcos:"$STREAM" \
     "$commit"
 
-ostree admin \
-    os-init "$OSNAME" \
-    --sysroot "$mount_dir"
+deploy_opts=()
+if [ -z "$parent_image" ]; then
+    ostree admin \
+        os-init "$OSNAME" \
+        --sysroot "$mount_dir"
+else
+    # the same kernel arguments and /etc as the full image
+    deploy_opts=(--no-merge)
+fi
 
 OSTREE_BOOT_PARTITION="/boot" ostree admin deploy altcos:"$STREAM" \
+    "${deploy_opts[@]}" \
     --sysroot "$mount_dir" \
     --os "$OSNAME" \
     --karg-append=ignition.platform.id=qemu \
@@ -175,15 +236,24 @@ OSTREE_BOOT_PARTITION="/boot" ostree admin deploy altcos:"$STREAM" \
     --karg-append=quiet \
     --karg-append=root=UUID="$(blkid --match-tag UUID -o value "$root_part")"
 
-rm -rf "$mount_dir"/ostree/deploy/"$OSNAME"/var
+if [ -n "$parent_image" ]; then
+    # drop the parent deployment, the image boots only the new one
+    ostree admin undeploy --sysroot "$mount_dir" 1
 
-rsync -av "$commit_dir" \
-        "$mount_dir"/ostree/deploy/"$OSNAME"
+    # only the changed files of var go to the overlay
+    rsync -av --delete "$commit_dir"/ \
+        "$mount_dir"/ostree/deploy/"$OSNAME"/var/
+else
+    rm -rf "$mount_dir"/ostree/deploy/"$OSNAME"/var
+
+    rsync -av "$commit_dir" \
+            "$mount_dir"/ostree/deploy/"$OSNAME"
+fi
 
 touch "$mount_dir"/ostree/deploy/"$OSNAME"/var/.ostree-selabeled
 touch "$mount_dir"/boot/ignition.firstboot
 
-if [ "$efi_support" -eq 1 ]; then
+if [ "$efi_support" -eq 1 ] && [ -z "$parent_image" ]; then
     mkdir -p "$mount_dir_efi"/EFI/BOOT
     mv "$mount_dir_efi"/EFI/altlinux/shimx64.efi "$mount_dir_efi"/EFI/BOOT/bootx64.efi
     mv "$mount_dir_efi"/EFI/altlinux/{grubx64.efi,grub.cfg} "$mount_dir_efi"/EFI/BOOT/
@@ -192,11 +262,22 @@ fi
 echo "UUID=$(blkid --match-tag UUID -o value "$efi_part") /boot/efi vfat umask=0,quiet,showexec,iocharset=utf8,codepage=866 1 2" \
     >> "$mount_dir"/ostree/deploy/"$OSNAME"/deploy/"$commit".0/etc/fstab
 
+# unmap the blocks freed by the build (the raw file is sparse-copied below)
+fstrim "$mount_dir_efi"
+fstrim "$mount_dir"
+
 umount -R "$mount_dir"
-rm -rf "$mount_dir"
-losetup -d "$loop_dev"
+rmdir "$mount_dir"
+mount_dir=
+
+if [ -n "$raw_file" ]; then
+    losetup -d "$block_dev"
+    block_dev=
 
-qemu-img convert -O qcow2 "$raw_file" "$image_file"
-rm "$raw_file"
+    qemu-img convert -O qcow2 "$raw_file" "$image_file"
+else
+    qemu-nbd --disconnect "$block_dev" >/dev/null
+    block_dev=
+fi
 
-echo "$image_file"
\ No newline at end of file
+echo "$image_file"
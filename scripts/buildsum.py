@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import contextlib
+import dataclasses
+import hashlib
 import os
 import json
 import pathlib
 import sys
 import typing
 
-import pydantic
-
 import altcos
+import compression
 
 FormatMapping: typing.TypeAlias = dict[altcos.Format, altcos.Artifact]
 PlatformMapping: typing.TypeAlias = dict[altcos.Platform, FormatMapping]
@@ -16,99 +19,344 @@ VersionMapping: typing.TypeAlias = dict[str, PlatformMapping]
 StreamMapping: typing.TypeAlias = dict[str, VersionMapping]
 ArchMapping: typing.TypeAlias = dict[str, StreamMapping]
 BranchMapping: typing.TypeAlias = dict[altcos.Branch, ArchMapping]
+StreamSummary: typing.TypeAlias = tuple[str, str, VersionMapping]
+DumpedStream: typing.TypeAlias = tuple[str, str, dict[str, typing.Any]]
 
+SIGNATURE_SUFFIXES = tuple(f"{suffix}.sig" for suffix in compression.SUFFIXES)
 
-class Collector:
-    def __init__(self, branch: altcos.Branch, storage: str | os.PathLike) -> None:
-        self.branch = branch
-        self.storage = storage
-        self.root = pathlib.Path(self.storage, self.branch)
+# the artifact fields which get the size and sha256
+HASHED_FIELDS = ("location", "uncompressed")
 
-    def collect_artifact(
-        self,
-        arch: altcos.Arch,
-        stream: str,
-        version: altcos.Version,
-        platform: altcos.Platform,
-        fmt: altcos.Format,
-    ) -> altcos.Artifact:
+
+def dump_platforms(platforms: PlatformMapping) -> dict[str, typing.Any]:
+    return {
+        platform: {
+            fmt: {
+                field: str(value) if value is not None else None
+                for field, value in dataclasses.asdict(artifact).items()
+            }
+            for fmt, artifact in formats.items()
+        }
+        for platform, formats in platforms.items()
+    }
+
+
+def dump_versions(versions: VersionMapping) -> dict[str, typing.Any]:
+    return {version: dump_platforms(platforms) for version, platforms in versions.items()}
+
+
+class Hasher:
+    """sizes and sha256 of the artifacts
+
+    Files are hashed in a thread pool (hashlib releases the GIL on large
+    blocks). The results are kept in a sidecar file keyed by the path and
+    checked by (inode, size, mtime_ns), so only the new or changed
+    artifacts are read.
+    """
+
+    BLOCK_SIZE = 1 << 22
+
+    def __init__(self, path: pathlib.Path, jobs: int) -> None:
+        self.path = path
+        self.jobs = jobs
+        self.entries: dict[str, list[typing.Any]] = {}
+
+        try:
+            self.cache = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.cache = {}
+
+    @classmethod
+    def sha256(cls, path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb", buffering=0) as file:
+            while block := file.read(cls.BLOCK_SIZE):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def sums(self, paths: typing.Iterable[str]) -> dict[str, tuple[int, str]]:
+        """return the size and sha256 of every file"""
+
+        missing = {}
+        for path in paths:
+            stat = os.stat(path)
+            key = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+            if (entry := self.cache.get(path)) is not None and entry[:3] == key:
+                self.entries[path] = entry
+            else:
+                missing[path] = key
+
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+                for path, digest in zip(missing, pool.map(self.sha256, missing)):
+                    self.entries[path] = [*missing[path], digest]
+
+        return {path: (self.entries[path][1], self.entries[path][3]) for path in paths}
+
+    def dump_versions(self, versions: VersionMapping) -> dict[str, typing.Any]:
+        """dump the versions with `<field>_size` and `<field>_sha256` of the artifacts"""
+
+        dumped = dump_versions(versions)
         artifacts = [
             artifact
-            for artifact in self.root.glob(
-                f"{arch}/{stream}/{version}/{platform}/{fmt}/*"
-            )
+            for platforms in dumped.values()
+            for formats in platforms.values()
+            for artifact in formats.values()
         ]
 
-        [location, signature, uncompressed, uncompressed_signature] = [None] * 4
+        paths = [a[field] for a in artifacts for field in HASHED_FIELDS if a[field] is not None]
+        sums = self.sums(paths)
 
         for artifact in artifacts:
-            if artifact.name.endswith(".xz.sig"):
-                signature = artifact
-            elif artifact.name.endswith(".xz"):
-                location = artifact
-            elif artifact.name.endswith(".sig"):
-                uncompressed_signature = artifact
-            else:
-                uncompressed = artifact
+            for field in HASHED_FIELDS:
+                if (path := artifact[field]) is not None:
+                    artifact[f"{field}_size"], artifact[f"{field}_sha256"] = sums[path]
+
+        return dumped
+
+    def save(self) -> None:
+        """keep only the entries of the existing artifacts"""
+
+        with publish(self.path) as file:
+            json.dump(self.entries, file)
+
+
+def scan_dirs(path: str | os.PathLike) -> list[os.DirEntry]:
+    try:
+        with os.scandir(path) as entries:
+            return [entry for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+class Collector:
+    """collects the branch builds with a single `os.scandir` walk
+
+    With a `manifest` (the previous results of the version directories and
+    their stamps) only the version directories whose stamp has changed are
+    rescanned. The stamp is the mtime of the version directory and of its
+    platform and format directories, which change whenever an artifact is
+    added, replaced or removed.
+    """
+
+    def __init__(
+        self,
+        branch: altcos.Branch,
+        storage: str | os.PathLike,
+        manifest: dict[str, typing.Any] | None = None,
+    ) -> None:
+        self.branch = branch
+        self.storage = storage
+        self.root = pathlib.Path(self.storage, self.branch)
+        self.manifest = manifest
+        self.new_manifest: dict[str, typing.Any] = {}
+
+    def collect_artifact(self, path: str) -> altcos.Artifact:
+        [location, signature, uncompressed, uncompressed_signature] = [None] * 4
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                artifact = pathlib.Path(entry.path)
+                if entry.name.endswith(SIGNATURE_SUFFIXES):
+                    signature = artifact
+                elif entry.name.endswith(compression.SUFFIXES):
+                    location = artifact
+                elif entry.name.endswith(".sig"):
+                    uncompressed_signature = artifact
+                else:
+                    uncompressed = artifact
 
         return altcos.Artifact(
             location, signature, uncompressed, uncompressed_signature
         )
 
-    def collect_format(
-        self,
-        arch: altcos.Arch,
-        stream: str,
-        version: altcos.Version,
-        platform: altcos.Platform,
-    ) -> FormatMapping:
-        formats = {}
-        for fmt in self.root.glob(f"{arch}/{stream}/{version}/{platform}/*"):
-            fmt = altcos.Format(fmt.name)
-            formats[fmt] = self.collect_artifact(arch, stream, version, platform, fmt)
-        return formats
-
-    def collect_platform(
-        self, arch: altcos.Arch, stream: str, version: altcos.Version
-    ) -> PlatformMapping:
-        platforms = {}
-        for platform in self.root.glob(f"{arch}/{stream}/{version}/*"):
-            platform = altcos.Platform(platform.name)
-            platforms[platform] = self.collect_format(arch, stream, version, platform)
+    def collect_format(self, path: str) -> FormatMapping:
+        return {
+            altcos.Format(fmt.name): self.collect_artifact(fmt.path)
+            for fmt in scan_dirs(path)
+        }
+
+    def collect_platform(self, path: str) -> PlatformMapping:
+        return {
+            altcos.Platform(platform.name): self.collect_format(platform.path)
+            for platform in scan_dirs(path)
+        }
+
+    @staticmethod
+    def stamp(path: str) -> list[int]:
+        paths = [path]
+        for platform, formats in altcos.ALLOWED_BUILDS.items():
+            paths.append(os.path.join(path, platform))
+            paths.extend(os.path.join(path, platform, fmt) for fmt in formats)
+
+        stamp = []
+        for path in paths:
+            try:
+                stamp.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                stamp.append(0)
+
+        return stamp
+
+    def collect_version(self, key: str, path: str) -> PlatformMapping:
+        if self.manifest is None:
+            return self.collect_platform(path)
+
+        stamp = self.stamp(path)
+        if (entry := self.manifest.get(key)) is not None and entry["stamp"] == stamp:
+            platforms = {
+                altcos.Platform(platform): {
+                    altcos.Format(fmt): altcos.Artifact(**artifact)
+                    for fmt, artifact in formats.items()
+                }
+                for platform, formats in entry["platforms"].items()
+            }
+        else:
+            platforms = self.collect_platform(path)
+
+        self.new_manifest[key] = {"stamp": stamp, "platforms": dump_platforms(platforms)}
+
         return platforms
 
-    def collect_version(self, arch: altcos.Arch, stream: str) -> VersionMapping:
+    def collect_stream(self, arch: str, stream: os.DirEntry) -> VersionMapping:
         versions = {}
-        for version in self.root.glob(f"{arch}/{stream}/*"):
-            version_name = f"{self.branch}_{stream}.{version.name}"
-            versions[version.name] = self.collect_platform(
-                arch, stream, altcos.Version.from_str(version_name)
-            )
+        for version in scan_dirs(stream.path):
+            # make sure that the directory is a version
+            altcos.Version.from_str(f"{self.branch}_{stream.name}.{version.name}")
+            key = f"{arch}/{stream.name}/{version.name}"
+            versions[version.name] = self.collect_version(key, version.path)
         return versions
 
-    def collect_stream(self, arch: altcos.Arch) -> StreamMapping:
-        streams = {}
-        for stream in self.root.glob(f"{arch}/*"):
-            streams[stream.name] = self.collect_version(arch, stream.name)
-        return streams
+    def collect_streams(self) -> typing.Iterator[StreamSummary]:
+        """yield the builds of every arch/stream one by one"""
 
-    def collect_arch(self) -> ArchMapping:
-        architectures = {}
-        for arch in self.root.glob("*"):
-            arch = altcos.Arch(arch.name)
-            architectures[arch.value] = self.collect_stream(arch)
-        return architectures
+        for arch in scan_dirs(self.root):
+            arch_name = altcos.Arch(arch.name).value
+            for stream in scan_dirs(arch.path):
+                yield arch_name, stream.name, self.collect_stream(arch_name, stream)
 
     def collect(self) -> BranchMapping:
-        return {self.branch: self.collect_arch()}
+        architectures: ArchMapping = {}
+        for arch, stream, versions in self.collect_streams():
+            architectures.setdefault(arch, {})[stream] = versions
+        return {self.branch: architectures}
+
+
+@contextlib.contextmanager
+def publish(path: pathlib.Path) -> typing.Iterator[typing.TextIO]:
+    """write the file under a temporary name and rename it into place
+
+    Readers see either the previous or the complete new file.
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+
+    try:
+        with open(tmp, "w") as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def dump_json(obj: typing.Any, file: typing.TextIO, indent: int | None) -> str:
+    """stream the JSON of the object into the file and return its sha256"""
+
+    digest = hashlib.sha256()
+    for chunk in json.JSONEncoder(indent=indent).iterencode(obj):
+        file.write(chunk)
+        digest.update(chunk.encode())
+    return digest.hexdigest()
+
+
+def version_key(version: str) -> tuple[int, ...]:
+    return tuple(map(int, version.split(".")))
+
+
+class SummaryWriter:
+    """writes the branch summary sharded by arch/stream
 
+    `<storage>/summary/<branch>/<arch>/<stream>.json` holds the builds of a
+    stream, the `<storage>/summary/<branch>.json` index lists the shards
+    with their sha256, versions count and the latest version, so a client
+    fetches only the stream it tracks. Only one stream is kept in memory.
+    """
 
-class SisyphusBuilds(pydantic.BaseModel):
-    sisyphus: typing.Any
+    def __init__(self, storage: str | os.PathLike, branch: altcos.Branch, indent: int | None) -> None:
+        self.root = pathlib.Path(storage, "summary")
+        self.branch = branch
+        self.indent = indent
+        self.streams: dict[str, dict[str, typing.Any]] = {}
+
+    def write_shards(self, streams: typing.Iterable[DumpedStream]) -> typing.Iterator[DumpedStream]:
+        """write the stream shards and pass the streams through"""
+
+        for arch, stream, versions in streams:
+            shard = pathlib.Path(self.branch, arch, f"{stream}.json")
+            with publish(self.root.joinpath(shard)) as file:
+                digest = dump_json(versions, file, self.indent)
+
+            self.streams[f"{arch}/{stream}"] = {
+                "path": str(shard),
+                "sha256": digest,
+                "versions": len(versions),
+                "latest": max(versions, key=version_key, default=None),
+            }
+
+            yield arch, stream, versions
+
+    def write_index(self) -> None:
+        index = {"branch": self.branch, "streams": self.streams}
+        with publish(self.root.joinpath(f"{self.branch}.json")) as file:
+            dump_json(index, file, self.indent)
+
+        # drop the shards of the removed streams
+        shards = {self.root.joinpath(entry["path"]) for entry in self.streams.values()}
+        for shard in self.root.joinpath(self.branch).glob("*/*.json"):
+            if shard not in shards:
+                shard.unlink()
+
+
+def dump_streams(
+    streams: typing.Iterable[StreamSummary], hasher: Hasher | None
+) -> typing.Iterator[DumpedStream]:
+    for arch, stream, versions in streams:
+        if hasher is not None:
+            yield arch, stream, hasher.dump_versions(versions)
+        else:
+            yield arch, stream, dump_versions(versions)
+
+
+def write_branch(
+    file: typing.TextIO,
+    branch: altcos.Branch,
+    streams: typing.Iterable[DumpedStream],
+    indent: int | None,
+) -> None:
+    """stream the whole branch summary ({branch: {arch: {stream: ...}}})"""
 
+    file.write(f"{{{json.dumps(branch)}: {{")
 
-class P10Builds(pydantic.BaseModel):
-    p10: typing.Any
+    current_arch = None
+    for arch, stream, versions in streams:
+        if arch != current_arch:
+            if current_arch is not None:
+                file.write("}, ")
+            file.write(f"{json.dumps(arch)}: {{")
+            current_arch = arch
+        else:
+            file.write(", ")
+
+        file.write(f"{json.dumps(stream)}: ")
+        dump_json(versions, file, indent)
+
+    if current_arch is not None:
+        file.write("}")
+    file.write("}}\n")
 
 
 def main() -> None:
@@ -123,22 +371,54 @@ def main() -> None:
     parser.add_argument("storage", help="builds storage root")
     parser.add_argument("-w", "--write", action="store_true", help="Write build summary to the root storage")
     parser.add_argument("-i", "--indent", type=int)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Rescan only the changed version directories (keeps a manifest in the storage root)",
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--no-hash", action="store_true", help="Do not record the artifacts size and sha256"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="Threads hashing the artifacts"
+    )
 
-    builds = {altcos.Branch.SISYPHUS: SisyphusBuilds, altcos.Branch.P10: P10Builds}
+    args = parser.parse_args()
 
     branch = altcos.Branch(args.branch)
-    summary = Collector(branch, args.storage).collect()
-    summary = builds[branch].model_validate(summary).model_dump(mode="json")
-    
+    manifest_path = pathlib.Path(args.storage, f".{args.branch}.manifest.json")
+
+    manifest = None
+    if args.incremental:
+        try:
+            manifest = json.loads(manifest_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = {}
+
+    collector = Collector(branch, args.storage, manifest)
+    hasher = None
+    if not args.no_hash:
+        hasher = Hasher(pathlib.Path(args.storage, f".{args.branch}.hashes.json"), args.jobs)
+
+    streams = dump_streams(collector.collect_streams(), hasher)
 
     if args.write:
-        summary_path = pathlib.Path(args.storage, f"{args.branch}.json")
-        with open(summary_path, "w") as file:
-            json.dump(summary, file, indent=args.indent)
+        writer = SummaryWriter(args.storage, branch, args.indent)
+        # the whole branch file is kept for the old clients
+        with publish(pathlib.Path(args.storage, f"{args.branch}.json")) as file:
+            write_branch(file, branch, writer.write_shards(streams), args.indent)
+        writer.write_index()
     else:
-        print(json.dumps(summary, indent=args.indent))
+        write_branch(sys.stdout, branch, streams, args.indent)
+
+    if hasher is not None:
+        hasher.save()
+
+    if args.incremental:
+        with publish(manifest_path) as file:
+            json.dump(collector.new_manifest, file)
+
 
 if __name__ == "__main__":
     main()
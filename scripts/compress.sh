@@ -43,16 +43,11 @@ format=$6
 
 check_args stream repo_root commit storage platform format
 
-check_stream "$stream" "$repo_root"
-export_stream "$stream" "$repo_root"
+describe_stream "$stream" "$repo_root" bare "$commit"
+require_envs COMMIT
 
-commit="$(get_commit "$stream" "$repo_root" "bare" "$commit")"
-
-version="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    version \
-    --commit "$commit")"
+commit="$COMMIT"
+version="$VERSION"
 
 build_dir="$(get_artifact_dir \
     "$stream" \
@@ -64,5 +59,6 @@ build_dir="$(get_artifact_dir \
 
 image_file="$build_dir"/"$BRANCH"_"$NAME"."$ARCH"."$version"."$platform"."$format"
 
-xz -9 -T0 --memlimit=2048MiB "$image_file"
+# the codec is chosen by COMPRESSION_<PLATFORM>_<FORMAT> or COMPRESSION (xz:9 by default)
+python3 "$__dir"/compression.py compress "$platform" "$format" "$image_file"
 
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""Image compression codecs
+
+A codec is chosen by a "<codec>[:<level>]" spec (e.g. "zstd-long:19"). The
+spec of an artifact is taken from the `COMPRESSION_<PLATFORM>_<FORMAT>`
+environment variable (e.g. `COMPRESSION_QEMU_QCOW2`), then `COMPRESSION`,
+then "xz:9". The environment variables are set by the exported acosa
+variables.
+
+    compression.py compress <platform> <format> <image>
+    compression.py command <spec>
+    compression.py compressed <image>
+    compression.py bench <image> [-s <spec> ...]
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+# run by the non-root services too, so only the standard library is used
+logger = logging.getLogger(__name__)
+
+RUSAGE_SCRIPT = pathlib.Path(__file__).with_name("rusage.py")
+
+DEFAULT_SPEC = "xz:9"
+BENCH_SPECS = ["xz:6", "xz:9", "zstd:3", "zstd:19", "zstd-long:19", "gzip:6", "pigz:6"]
+
+
+class CompressionError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Codec:
+    name: str
+    suffix: str
+    compress_cmd: tuple[str, ...]
+    decompress_cmd: tuple[str, ...]
+    default_level: int
+    levels: range
+
+    def compress_args(self, level: int | None = None) -> list[str]:
+        level = self.default_level if level is None else level
+        if level not in self.levels:
+            raise CompressionError(f'invalid {self.name} level "{level}"')
+        return [arg.format(level=level) for arg in self.compress_cmd]
+
+    def decompress_args(self) -> list[str]:
+        return list(self.decompress_cmd)
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (
+        Codec(
+            "xz",
+            ".xz",
+            ("xz", "-{level}", "-T0", "--memlimit=2048MiB", "-c"),
+            ("xz", "-dc"),
+            9,
+            range(0, 10),
+        ),
+        Codec(
+            "zstd",
+            ".zst",
+            ("zstd", "-{level}", "-T0", "-q", "-c"),
+            ("zstd", "-dc", "-q"),
+            19,
+            range(1, 20),
+        ),
+        Codec(
+            "zstd-long",
+            ".zst",
+            ("zstd", "-{level}", "--long=27", "-T0", "-q", "-c"),
+            ("zstd", "-dc", "-q", "--long=27"),
+            19,
+            range(1, 20),
+        ),
+        Codec("gzip", ".gz", ("gzip", "-{level}", "-c"), ("gzip", "-dc"), 9, range(1, 10)),
+        Codec("pigz", ".gz", ("pigz", "-{level}", "-c"), ("pigz", "-dc"), 9, range(1, 10)),
+    )
+}
+
+# suffixes of the compressed artifacts (used by buildsum.py)
+SUFFIXES = tuple(sorted({codec.suffix for codec in CODECS.values()}))
+
+
+def parse_spec(spec: str) -> tuple[Codec, int]:
+    name, _, level = spec.partition(":")
+
+    if (codec := CODECS.get(name)) is None:
+        raise CompressionError(f'unknown codec "{name}" (expected one of {", ".join(CODECS)})')
+
+    try:
+        level = int(level) if level else codec.default_level
+    except ValueError:
+        raise CompressionError(f'invalid level in "{spec}"') from None
+
+    codec.compress_args(level)
+
+    return codec, level
+
+
+def get_spec(platform: str, fmt: str, env: typing.Mapping[str, str] = os.environ) -> str:
+    """return the compression spec of the artifact"""
+
+    return env.get(f"COMPRESSION_{platform}_{fmt}".upper()) or env.get("COMPRESSION") or DEFAULT_SPEC
+
+
+def get_backing_file(image: pathlib.Path) -> str | None:
+    """return the backing file of the qcow2 image (None for the other images)"""
+
+    if image.suffix != ".qcow2":
+        return None
+
+    try:
+        proc = subprocess.run(
+            ["qemu-img", "info", "--output=json", str(image)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        raise CompressionError(f'failed to inspect "{image}" ({e})') from None
+    if proc.returncode != 0:
+        raise CompressionError(f'failed to inspect "{image}": {proc.stderr.decode().strip()}')
+
+    try:
+        return json.loads(proc.stdout).get("backing-filename")
+    except ValueError:
+        raise CompressionError(f'failed to inspect "{image}": invalid qemu-img output') from None
+
+
+def check_standalone(image: pathlib.Path) -> None:
+    """refuse an incremental qcow2: its backing file path is only valid in
+    the storage it was built in"""
+
+    if (backing := get_backing_file(image)) is not None:
+        raise CompressionError(
+            f'"{image}" is an overlay of "{backing}", flatten it first (flatten-qcow2.sh)'
+        )
+
+
+def compress(image: pathlib.Path, spec: str) -> pathlib.Path:
+    """compress the image next to it, remove it and return the result path"""
+
+    check_standalone(image)
+
+    codec, level = parse_spec(spec)
+    compressed = image.with_name(image.name + codec.suffix)
+    tmp = compressed.with_name(f".{compressed.name}.tmp")
+
+    try:
+        with open(image, "rb") as src, open(tmp, "wb") as dst:
+            proc = subprocess.run(codec.compress_args(level), stdin=src, stdout=dst)
+        if proc.returncode != 0:
+            raise CompressionError(f'failed to compress "{image}" ({proc.returncode})')
+        tmp.replace(compressed)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    image.unlink()
+
+    return compressed
+
+
+def find_compressed(image: pathlib.Path) -> list[pathlib.Path]:
+    """return the existing compressed files of the image (any codec)"""
+
+    return [
+        path for suffix in SUFFIXES if (path := image.with_name(image.name + suffix)).is_file()
+    ]
+
+
+def measure(cmd: list[str], src: typing.BinaryIO, dst: typing.BinaryIO) -> tuple[float, int]:
+    """run the command and return its wall time and peak RSS (bytes)
+
+    The command is started by a shell which execs rusage.py after it, so
+    the peak RSS does not count this Python process (see rusage.py).
+    """
+
+    with tempfile.NamedTemporaryFile(prefix="compression-rusage-") as report:
+        launch = '"$@"\nexec ' + shlex.join(
+            [sys.executable, "-S", "-I", str(RUSAGE_SCRIPT), report.name]
+        ) + ' "$?"'
+
+        start = time.perf_counter()
+        returncode = subprocess.run(["sh", "-c", launch, "sh", *cmd], stdin=src, stdout=dst).returncode
+        wall = time.perf_counter() - start
+
+        if returncode != 0:
+            raise CompressionError(f'"{" ".join(cmd)}" failed ({returncode})')
+
+        rusage = json.load(report)
+
+    return wall, rusage["ru_maxrss"] * 1024
+
+
+def bench(image: pathlib.Path, spec: str) -> dict[str, typing.Any]:
+    codec, level = parse_spec(spec)
+    size = image.stat().st_size
+
+    with tempfile.NamedTemporaryFile(prefix="compression-bench-", dir=image.parent) as tmp:
+        with open(image, "rb") as src:
+            compress_wall, compress_rss = measure(codec.compress_args(level), src, tmp)
+        tmp.flush()
+        compressed_size = os.path.getsize(tmp.name)
+
+        with open(tmp.name, "rb") as src, open(os.devnull, "wb") as dst:
+            decompress_wall, decompress_rss = measure(codec.decompress_args(), src, dst)
+
+    return {
+        "spec": f"{codec.name}:{level}",
+        "ratio": size / compressed_size if compressed_size else 0.0,
+        "compress_mib_s": size / compress_wall / (1 << 20),
+        "decompress_mib_s": size / decompress_wall / (1 << 20),
+        "compress_rss_mib": compress_rss / (1 << 20),
+        "decompress_rss_mib": decompress_rss / (1 << 20),
+    }
+
+
+def main() -> None:
+    logging.basicConfig(format="%(message)s")
+
+    parser = argparse.ArgumentParser(description="Image compression codecs.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    compress_parser = subparsers.add_parser("compress", help="Compress the image of the platform/format")
+    compress_parser.add_argument("platform")
+    compress_parser.add_argument("format")
+    compress_parser.add_argument("image", type=pathlib.Path)
+
+    command_parser = subparsers.add_parser("command", help="Print the compression command of the spec")
+    command_parser.add_argument("spec")
+    command_parser.add_argument("--suffix", help="Fail if the codec makes another suffix")
+
+    compressed_parser = subparsers.add_parser(
+        "compressed", help="Print the existing compressed files of the image"
+    )
+    compressed_parser.add_argument("image", type=pathlib.Path)
+
+    bench_parser = subparsers.add_parser("bench", help="Benchmark the codecs on the image")
+    bench_parser.add_argument("image", type=pathlib.Path)
+    bench_parser.add_argument(
+        "-s", "--spec", action="append", help=f"Codec spec (default: {' '.join(BENCH_SPECS)})"
+    )
+    bench_parser.add_argument("-f", "--format", choices=["text", "json"], default="text")
+
+    args = parser.parse_args()
+
+    try:
+        if args.action == "compress":
+            print(compress(args.image, get_spec(args.platform, args.format)))
+
+        elif args.action == "command":
+            codec, level = parse_spec(args.spec)
+            if args.suffix is not None and codec.suffix != args.suffix:
+                raise CompressionError(f'"{args.spec}" does not make "{args.suffix}" files')
+            print(" ".join(codec.compress_args(level)))
+
+        elif args.action == "compressed":
+            if not (paths := find_compressed(args.image)):
+                raise CompressionError(f'no compressed files of "{args.image}"')
+            print("\n".join(map(str, paths)))
+
+        else:
+            results = []
+            for spec in args.spec or BENCH_SPECS:
+                if shutil.which(parse_spec(spec)[0].compress_cmd[0]) is None:
+                    logger.warning(f'skip "{spec}": the codec is not installed')
+                    continue
+                results.append(bench(args.image, spec))
+
+            if args.format == "json":
+                print(json.dumps(results))
+                return
+
+            print(f"{'spec':<14} {'ratio':>7} {'comp MiB/s':>11} {'dec MiB/s':>10} {'comp RSS':>9} {'dec RSS':>8}")
+            for r in results:
+                print(
+                    f"{r['spec']:<14} {r['ratio']:>7.3f} {r['compress_mib_s']:>11.1f} "
+                    f"{r['decompress_mib_s']:>10.1f} {r['compress_rss_mib']:>9.1f} "
+                    f"{r['decompress_rss_mib']:>8.1f}"
+                )
+    except CompressionError as e:
+        logger.fatal(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -40,9 +40,7 @@ url=$4
 message=$5
 
 check_args stream repo_root mode url message
-check_stream "$stream" "$repo_root"
-
-export_stream "$stream" "$repo_root" "$mode"
+describe_stream "$stream" "$repo_root" "$mode"
 
 output="$(is_base_stream "$NAME")"
 if [ "$output" = "no" ]; then
@@ -175,20 +173,8 @@ chroot "$root_tmpdir" dracut \
 rm -rf "$root_tmpdir"/usr/etc
 mv "$root_tmpdir"/etc "$root_tmpdir"/usr/etc
 
-# shellcheck disable=SC2155
-version="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    version \
-    --next major \
-    --view full)"
-
-version_path="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    version \
-    --next major \
-    --view path)"
+version="$NEXT_MAJOR_FULL"
+version_path="$NEXT_MAJOR_PATH"
 
 mkdir -p "$VARS_DIR"/"$version_path"
 rsync -av "$root_tmpdir"/var "$VARS_DIR"/"$version_path"
@@ -210,6 +196,9 @@ commit=$(
 
 cd "$VARS_DIR" || exit 1
 ln -sf "$version_path" "$commit"
+# the commit is already made, a stale index is updated by the next call
+stream_py "$stream" "$repo_root" --mode "$mode" index >/dev/null \
+    || warn "failed to update the commit index"
 
 rm -rf "$tmpdir"
 
@@ -0,0 +1,76 @@
+#!/usr/bin/env bash
+
+set -eo pipefail
+
+__dir=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+__name="$(basename "$0")"
+
+# shellcheck disable=SC1091
+source "$__dir"/utils.sh
+
+check_root_uid
+
+# shellcheck disable=SC2034
+usage="Usage: $__name [options] <stream> <repo-root> <mode> <storage> <commit>
+Flatten the incremental qcow2 image (merge its backing chain) for publication
+
+Arguments:
+    stream - ALTCOS repository stream (e.g. \"altcos/x86_64/sisyphus/base\")
+    repo-root - ALTCOS repository root
+    mode - OSTree repository mode
+    storage - image storage root
+    commit - base commit hashsum or \"latest\"
+
+    Options:
+        -a, --api - print API-like arguments (e.g. \"\$stream \$repo-root\")
+        -h, --help - print this message"
+
+
+need_api=0
+handle_options "$@"
+if [ "$need_api" -eq 1 ]; then
+    echo -n "\$stream" "\$repo_root" "\$mode" "\$storage" "\$commit"
+    exit
+fi
+
+stream=$1
+repo_root=$2
+mode=$3
+storage=$4
+commit=$5
+
+platform=qemu
+format=qcow2
+
+check_args stream repo_root mode storage commit
+
+describe_stream "$stream" "$repo_root" "$mode" "$commit"
+require_envs COMMIT
+
+version="$VERSION"
+
+build_dir="$(get_artifact_dir \
+    "$stream" \
+    "$repo_root" \
+    "$version" \
+    "$platform" \
+    "$format" \
+    "$storage")"
+
+image_file="$build_dir"/"$BRANCH"_"$NAME"."$ARCH"."$version"."$platform"."$format"
+
+if [ ! -f "$image_file" ]; then
+    fatal "image \"$image_file\" does not exist"
+    exit 1
+fi
+
+# the full image is already flat
+if qemu-img info "$image_file" | grep -q '^backing file:'; then
+    flat_file=$(mktemp -p "$build_dir" ."$(basename "$image_file")"-XXXXXX)
+    trap 'rm -f "$flat_file"' EXIT
+
+    qemu-img convert -O qcow2 "$image_file" "$flat_file"
+    mv "$flat_file" "$image_file"
+fi
+
+echo "$image_file"
@@ -42,36 +42,33 @@ next=$5
 message=$6
 
 check_args stream repo_root mode commit next message
-check_stream "$stream" "$repo_root"
+case "$next" in
+    major|minor) ;;
+    *)
+        fatal "invalid version part \"$next\" (major|minor)"
+        exit 1;;
+esac
 
-export_stream "$stream" "$repo_root" "$mode"
+describe_stream "$stream" "$repo_root" "$mode" "$commit"
 
 if [ ! -e "$MERGED_DIR" ]; then
     fatal "directory \"$MERGED_DIR\" does not exists ( try to make checkout.sh )"
     exit 1
 fi
 
-guess_commit="$(get_commit "$stream" "$repo_root" "$mode" "$commit")"
+# the stream without commits gets <date>.0.0 as the next version
+next_version="NEXT_${next^^}_FULL"
+next_version_path="NEXT_${next^^}_PATH"
+version="${!next_version}"
+version_path="${!next_version_path}"
+
+guess_commit="$COMMIT"
 if [ -z "$guess_commit" ]; then
     # if the commit does not exist yet, let's take the parent branch as a basis
     guess_commit="$(get_commit altcos/"$ARCH"/"$BRANCH"/base "$repo_root" "$mode" "$commit")"
-    # in order for the substream version starts from <date>.0.0, need to remove the base stream commit from the argumets
-    version_get_args="$stream $repo_root --mode $mode version --next $next"
-else
-    version_get_args="$stream $repo_root --mode $mode version --commit $guess_commit --next $next"
 fi
 commit="$guess_commit"
 
-# shellcheck disable=SC2086
-version="$(python3 "$__dir"/../stream.py \
-    $version_get_args \
-    --view full)"
-
-# shellcheck disable=SC2086
-version_path="$(python3 "$__dir"/../stream.py \
-    $version_get_args \
-    --view path)"
-
 var_dir="$VARS_DIR"/"$version_path"
 
 cd "$WORK_DIR"
@@ -132,6 +129,9 @@ ln -sf "$version_path" "$new_commit"
 rm -rf "$commit"
 
 ostree summary --repo="$ostree_dir" --update
+# the commit is already made, a stale index is updated by the next call
+stream_py "$stream" "$repo_root" --mode "$mode" index >/dev/null \
+    || warn "failed to update the commit index"
 
 rm -rf "$WORK_DIR"
 
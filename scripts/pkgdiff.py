@@ -2,8 +2,17 @@
 from __future__ import annotations
 
 import argparse
+import array
+import bisect
+import concurrent.futures
+import contextlib
 import dataclasses
+import functools
+import heapq
+import itertools
+import os
 import shlex
+import struct
 import json
 import pathlib
 import sys
@@ -11,23 +20,31 @@ import tempfile
 import typing
 import subprocess
 import logging
+import zlib
 
 import rpm
 import altcos
+from gi.repository import GLib
 
 import colorlog
+from pkgindex import PackageIndex, compare_evr, split_evr
 
 logger = colorlog.get_logger(__name__, logging.StreamHandler(), fmt="%(message)s")
 
 
 PROGRAM_NAME = pathlib.Path(sys.argv[0]).name
+PACKAGES_PATH = "/lib/rpm/Packages"
 
 
 @dataclasses.dataclass
 class Package:
-    __slots__ = ("_header",)
+    __slots__ = ("name", "epoch", "version", "release", "summary")
 
-    _header: rpm.hdr
+    name: str
+    epoch: int | None
+    version: str
+    release: str
+    summary: str
 
     def __hash__(self) -> int:
         return hash(self.name)
@@ -36,33 +53,32 @@ class Package:
         return f"{self.name}-{self.version}-{self.release}"
 
     def __eq__(self, other: Package) -> bool:
-        return rpm.versionCompare(self._header, other._header) == 0
+        return rpm.labelCompare(self.evr, other.evr) == 0
 
     def __lt__(self, other: Package) -> bool:
-        return rpm.versionCompare(self._header, other._header) == -1
+        return rpm.labelCompare(self.evr, other.evr) == -1
 
     def __gt__(self, other: Package) -> bool:
-        return rpm.versionCompare(self._header, other._header) == 1
+        return rpm.labelCompare(self.evr, other.evr) == 1
 
-    @property
-    def name(self) -> str:
-        return self._header[rpm.RPMTAG_NAME].decode()
-
-    @property
-    def version(self) -> str:
-        return self._header[rpm.RPMTAG_VERSION].decode()
-
-    @property
-    def release(self) -> str:
-        return self._header[rpm.RPMTAG_RELEASE].decode()
+    @classmethod
+    def from_header(cls, hdr: rpm.hdr) -> Package:
+        return cls(
+            hdr[rpm.RPMTAG_NAME].decode(),
+            hdr[rpm.RPMTAG_EPOCH],
+            hdr[rpm.RPMTAG_VERSION].decode(),
+            hdr[rpm.RPMTAG_RELEASE].decode(),
+            hdr[rpm.RPMTAG_SUMMARY].decode(),
+        )
 
     @property
-    def epoch(self) -> int:
-        return self._header[rpm.RPMTAG_EPOCH]
+    def evr(self) -> tuple[str | None, str, str]:
+        epoch = str(self.epoch) if self.epoch is not None else None
+        return epoch, self.version, self.release
 
     @property
-    def summary(self) -> str:
-        return self._header[rpm.RPMTAG_SUMMARY].decode()
+    def evr_str(self) -> str:
+        return join_evr(*self.evr)
 
     def to_dict(self) -> dict:
         return {
@@ -74,10 +90,163 @@ class Package:
         }
 
 
-PackageMapping: typing.TypeAlias = dict[str, Package]
 PackageUnwrapMapping: typing.TypeAlias = dict[str, dict[str, str]]
 
 
+def join_evr(epoch: str | None, version: str, release: str) -> str:
+    return f"{epoch}:{version}-{release}" if epoch is not None else f"{version}-{release}"
+
+
+def rank_evrs(evrs: typing.Iterable[str]) -> dict[str, int]:
+    """return the sort keys of the EVR strings (equal EVRs share a rank)"""
+
+    ranks = {}
+    previous = None
+    for evr in sorted(set(evrs), key=functools.cmp_to_key(compare_evr)):
+        if previous is None or compare_evr(previous, evr) != 0:
+            rank = len(ranks)
+        ranks[evr] = rank
+        previous = evr
+
+    return ranks
+
+
+class Manifest:
+    """compact package manifest
+
+    Packages are kept as columns sorted by name, then by EVR (a name may
+    have several packages, e.g. kernels or multilib). EVR strings are
+    interned (`evr_ids` points into `evrs`) with their precomputed sort
+    keys (`evr_keys`, equal EVRs share a key), so a manifest holds no
+    per-package objects and two or more manifests are compared with linear
+    merges. `Package` objects are only made for the output.
+    """
+
+    __slots__ = ("names", "summaries", "evrs", "evr_keys", "evr_ids")
+
+    MAGIC = b"PKM2"
+    HEADER = struct.Struct("!4sII")
+
+    def __init__(
+        self,
+        names: list[str],
+        summaries: list[str],
+        evrs: list[str],
+        evr_keys: array.array,
+        evr_ids: array.array,
+    ) -> None:
+        self.names = names
+        self.summaries = summaries
+        self.evrs = evrs
+        self.evr_keys = evr_keys
+        self.evr_ids = evr_ids
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def from_packages(cls, pkgs: typing.Iterable[Package]) -> Manifest:
+        pkgs = list(pkgs)
+        ranks = rank_evrs(pkg.evr_str for pkg in pkgs)
+        pkgs.sort(key=lambda pkg: (pkg.name, ranks[pkg.evr_str]))
+
+        interned: dict[str, int] = {}
+        evr_ids = array.array(
+            "I", (interned.setdefault(pkg.evr_str, len(interned)) for pkg in pkgs)
+        )
+        return cls(
+            [pkg.name for pkg in pkgs],
+            [pkg.summary for pkg in pkgs],
+            [*interned],
+            array.array("I", (ranks[evr] for evr in interned)),
+            evr_ids,
+        )
+
+    @staticmethod
+    def _unpack(content: bytes, count: int) -> array.array:
+        values = array.array("I")
+        values.frombytes(content[: count * values.itemsize])
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    @staticmethod
+    def _pack(values: array.array) -> bytes:
+        values = array.array("I", values)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> Manifest:
+        magic, count, evr_count = cls.HEADER.unpack_from(content)
+        if magic != cls.MAGIC:
+            raise ValueError(f"invalid manifest magic {magic!r}")
+
+        body = zlib.decompress(content[cls.HEADER.size :])
+
+        evr_ids = cls._unpack(body, count)
+        body = body[len(evr_ids) * evr_ids.itemsize :]
+        evr_keys = cls._unpack(body, evr_count)
+        body = body[len(evr_keys) * evr_keys.itemsize :]
+
+        strings = body.decode().split("\0")
+        if not count and not evr_count:
+            strings = []
+        if (
+            len(evr_ids) != count
+            or len(evr_keys) != evr_count
+            or len(strings) != 2 * count + evr_count
+        ):
+            raise ValueError("invalid manifest size")
+
+        return cls(
+            strings[:count], strings[count : 2 * count], strings[2 * count :], evr_keys, evr_ids
+        )
+
+    def to_bytes(self) -> bytes:
+        strings = "\0".join([*self.names, *self.summaries, *self.evrs]).encode()
+
+        return self.HEADER.pack(self.MAGIC, len(self), len(self.evrs)) + zlib.compress(
+            self._pack(self.evr_ids) + self._pack(self.evr_keys) + strings
+        )
+
+    def group(self, i: int) -> int:
+        """return the end of the packages with the name of the i-th one"""
+
+        return bisect.bisect_right(self.names, self.names[i], i)
+
+    def index(self, name: str) -> int | None:
+        """return the package of the name with the newest EVR"""
+
+        if (i := bisect.bisect_left(self.names, name)) < len(self) and self.names[i] == name:
+            return self.group(i) - 1
+        return None
+
+    def key(self, i: int) -> int:
+        return self.evr_keys[self.evr_ids[i]]
+
+    def evr(self, i: int) -> str:
+        return self.evrs[self.evr_ids[i]]
+
+    def package(self, i: int) -> Package:
+        epoch, version, release = split_evr(self.evr(i))
+        return Package(
+            self.names[i],
+            int(epoch) if epoch is not None else None,
+            version,
+            release,
+            self.summaries[i],
+        )
+
+    def packages(self) -> typing.Iterator[Package]:
+        return map(self.package, range(len(self)))
+
+
+class ManifestError(Exception):
+    pass
+
+
 class BDBReader:
     def __init__(self, content: bytes) -> None:
         self.content = content
@@ -85,14 +254,19 @@ class BDBReader:
     @classmethod
     def from_ostree_commit(cls, commit: altcos.Commit) -> BDBReader:
         cmd = shlex.split(
-            f"ostree cat {commit} --repo={commit.repo.path} /lib/rpm/Packages"
+            f"ostree cat {commit} --repo={commit.repo.path} {PACKAGES_PATH}"
         )
-        content = subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        ).stdout
-        return cls(content)
-
-    def read(self) -> PackageMapping:
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise ManifestError(f'failed to read the rpmdb of "{commit}": {e}') from None
+        if proc.returncode != 0 or not proc.stdout:
+            raise ManifestError(
+                f'failed to read the rpmdb of "{commit}": {proc.stderr.decode().strip()}'
+            )
+        return cls(proc.stdout)
+
+    def read(self) -> Manifest:
         with tempfile.TemporaryDirectory(prefix=PROGRAM_NAME) as dbpath:
             db = pathlib.Path(dbpath, "Packages")
             db.write_bytes(self.content)
@@ -100,17 +274,192 @@ class BDBReader:
             if dbpath:
                 rpm.addMacro("_dbpath", dbpath)
 
-            pkgs = {
-                hdr[rpm.RPMTAG_NAME]: Package(hdr)
-                for hdr in rpm.TransactionSet().dbMatch()
-            }
+            manifest = Manifest.from_packages(
+                map(Package.from_header, rpm.TransactionSet().dbMatch())
+            )
 
             if dbpath:
                 rpm.delMacro("_dbpath")
 
+        # an image always has packages, an empty list is a broken rpmdb
+        if not len(manifest):
+            raise ManifestError("no packages in the rpmdb")
+
+        return manifest
+
+
+class ManifestCache:
+    """content-addressed cache of the package manifests
+
+    A manifest is keyed by the checksum of the `Packages` rpmdb object, so
+    the rpmdb of every commit is parsed at most once, and the commits with
+    the same rpmdb (and both repository modes) share it.
+    """
+
+    def __init__(self, root: pathlib.Path) -> None:
+        self.root = root
+
+    @classmethod
+    def for_stream(cls, stream: altcos.Stream) -> ManifestCache:
+        return cls(stream.ostree_dir.joinpath("manifests"))
+
+    @staticmethod
+    def checksum(commit: altcos.Commit) -> str | None:
+        try:
+            root = commit.repo.storage.read_commit(str(commit), None)[1]
+            packages = root.resolve_relative_path(PACKAGES_PATH)
+            packages.ensure_resolved()
+        except GLib.Error:
+            return None
+        return packages.get_checksum()
+
+    def load(self, checksum: str) -> Manifest | None:
+        try:
+            return Manifest.from_bytes(self.root.joinpath(f"{checksum}.pkm").read_bytes())
+        except (FileNotFoundError, ValueError, struct.error, zlib.error):
+            return None
+
+    def store(self, checksum: str, manifest: Manifest) -> None:
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = self.root.joinpath(f"{checksum}.tmp")
+            tmp.write_bytes(manifest.to_bytes())
+            tmp.replace(self.root.joinpath(f"{checksum}.pkm"))
+        except OSError as e:
+            logger.warning(f'failed to cache "{checksum}" manifest ({e})')
+
+    def read(self, commit: altcos.Commit) -> Manifest:
+        """return the commit manifest, a failed read raises ManifestError
+        and is never cached"""
+
+        if (checksum := self.checksum(commit)) is None:
+            return BDBReader.from_ostree_commit(commit).read()
+
+        if (pkgs := self.load(checksum)) is None:
+            pkgs = BDBReader.from_ostree_commit(commit).read()
+            self.store(checksum, pkgs)
+
         return pkgs
 
 
+class MetadataStore:
+    """delta-encoded package lists of the commits
+
+    A record `<ostree_dir>/metadata/<commit>.json` keeps the commit
+    metadata and either the full package list (a snapshot, on every
+    `SNAPSHOT_INTERVAL`-th commit of a chain and when the parent record is
+    missing) or the packages added/changed and the (name, EVR) pairs removed
+    against the parent.
+    Any list is rebuilt from at most `SNAPSHOT_INTERVAL` records.
+    """
+
+    SNAPSHOT_INTERVAL = 32
+    FIELDS = ("reference", "version", "description", "commit", "parent")
+
+    def __init__(self, root: pathlib.Path) -> None:
+        self.root = root
+
+    @classmethod
+    def for_stream(cls, stream: altcos.Stream) -> MetadataStore:
+        return cls(stream.ostree_dir.joinpath("metadata"))
+
+    def load(self, commit: str) -> dict[str, typing.Any] | None:
+        try:
+            return json.loads(self.root.joinpath(f"{commit}.json").read_text())
+        except FileNotFoundError:
+            return None
+
+    def add(
+        self,
+        metadata: dict[str, typing.Any],
+        pkgs: Manifest,
+        parent_pkgs: Manifest | None,
+    ) -> None:
+        record = {field: metadata[field] for field in self.FIELDS}
+
+        parent = None
+        if metadata["parent"] is not None and parent_pkgs is not None:
+            parent = self.load(metadata["parent"])
+
+        if parent is None or parent["depth"] + 1 >= self.SNAPSHOT_INTERVAL:
+            record["depth"] = 0
+            record["snapshot"] = [pkg.to_dict() for pkg in pkgs.packages()]
+        else:
+            pairs = list(merge_manifests(pkgs, parent_pkgs))
+            record["depth"] = parent["depth"] + 1
+            record["added"] = [
+                pkgs.package(i).to_dict()
+                for i, j in pairs
+                if i is not None
+                and (
+                    j is None
+                    or pkgs.evr(i) != parent_pkgs.evr(j)
+                    or pkgs.summaries[i] != parent_pkgs.summaries[j]
+                )
+            ]
+            record["removed"] = [
+                [parent_pkgs.names[j], parent_pkgs.evr(j)]
+                for i, j in pairs
+                if j is not None and (i is None or pkgs.evr(i) != parent_pkgs.evr(j))
+            ]
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root.joinpath(f"{metadata['commit']}.tmp")
+        tmp.write_text(json.dumps(record))
+        tmp.replace(self.root.joinpath(f"{metadata['commit']}.json"))
+
+    def packages(self, commit: str) -> Manifest | None:
+        """rebuild the package list of the commit (None if it is not stored)"""
+
+        records = []
+        while (record := self.load(commit)) is not None:
+            records.append(record)
+            if "snapshot" in record:
+                break
+            commit = record["parent"]
+        else:
+            return None
+
+        # a name may have several packages, they are told apart by the EVR
+        snapshot = [Package(**pkg) for pkg in records.pop()["snapshot"]]
+        pkgs = {(pkg.name, pkg.evr_str): pkg for pkg in snapshot}
+        for record in reversed(records):
+            for removed in record["removed"]:
+                if isinstance(removed, str):
+                    # records written before the EVR was stored
+                    for key in [key for key in pkgs if key[0] == removed]:
+                        del pkgs[key]
+                else:
+                    pkgs.pop(tuple(removed), None)
+            for pkg in (Package(**pkg) for pkg in record["added"]):
+                pkgs[pkg.name, pkg.evr_str] = pkg
+
+        return Manifest.from_packages(pkgs.values())
+
+    def metadata(self, commit: str) -> dict[str, typing.Any] | None:
+        """return the commit metadata in the `metadata.json` layout
+
+        The diff is empty if the parent record is not stored (as for a
+        commit without a parent).
+        """
+
+        if (record := self.load(commit)) is None or (pkgs := self.packages(commit)) is None:
+            return None
+
+        parent_pkgs = self.packages(record["parent"]) if record["parent"] else None
+
+        return {
+            **{field: record[field] for field in self.FIELDS},
+            "package_info": make_package_info(pkgs, parent_pkgs),
+        }
+
+
+def read_packages(commit: altcos.Commit, cache: ManifestCache | None) -> Manifest:
+    if cache is None:
+        return BDBReader.from_ostree_commit(commit).read()
+    return cache.read(commit)
+
+
 @dataclasses.dataclass
 class UpdateDiff:
     __slots__ = ("new_pkg", "old_pkg")
@@ -125,13 +474,259 @@ class UpdateDiff:
         }
 
 
-def get_update_diff_list(a: PackageMapping, b: PackageMapping) -> list[UpdateDiff]:
-    return [UpdateDiff(a[n], b[n]) for n in a.keys() & b.keys() if a[n] > b[n]]
+def merge_group(
+    a: Manifest, a_range: range, b: Manifest, b_range: range
+) -> typing.Iterator[tuple[int | None, int | None]]:
+    """match the packages of one name: equal EVRs first, the rest in EVR order"""
+
+    b_evrs: dict[str, list[int]] = {}
+    for j in b_range:
+        b_evrs.setdefault(b.evr(j), []).append(j)
+
+    a_rest = []
+    for i in a_range:
+        if same := b_evrs.get(a.evr(i)):
+            yield i, same.pop(0)
+        else:
+            a_rest.append(i)
+
+    b_rest = sorted((j for js in b_evrs.values() for j in js), key=b.key)
+    a_rest.sort(key=a.key)
+    yield from itertools.zip_longest(a_rest, b_rest)
+
+
+def merge_manifests(
+    a: Manifest, b: Manifest
+) -> typing.Iterator[tuple[int | None, int | None]]:
+    """yield the package indices of both manifests by name (None if absent)"""
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a.names[i] < b.names[j]:
+            yield i, None
+            i += 1
+        elif a.names[i] > b.names[j]:
+            yield None, j
+            j += 1
+        else:
+            a_end, b_end = a.group(i), b.group(j)
+            if a_end - i == 1 and b_end - j == 1:
+                yield i, j
+            else:
+                yield from merge_group(a, range(i, a_end), b, range(j, b_end))
+            i, j = a_end, b_end
+
+    yield from ((i, None) for i in range(i, len(a)))
+    yield from ((None, j) for j in range(j, len(b)))
+
+
+def get_update_diff_list(a: Manifest, b: Manifest) -> list[UpdateDiff]:
+    return [
+        UpdateDiff(a.package(i), b.package(j))
+        for i, j in merge_manifests(a, b)
+        if i is not None and j is not None and compare_evr(a.evr(i), b.evr(j)) > 0
+    ]
+
+
+def get_unique_packages(a: Manifest, b: Manifest) -> list[Package]:
+    return [a.package(i) for i, j in merge_manifests(a, b) if j is None]
+
+
+def compare_manifests(
+    manifests: list[Manifest],
+) -> typing.Iterator[tuple[str, list[str | None]]]:
+    """yield every package name with its EVR in each manifest (None if
+    absent, the newest one if a manifest has several packages of the name)"""
+
+    columns = [
+        zip(manifest.names, itertools.repeat(k), itertools.count())
+        for k, manifest in enumerate(manifests)
+    ]
+
+    for name, group in itertools.groupby(heapq.merge(*columns), key=lambda x: x[0]):
+        evrs: list[str | None] = [None] * len(manifests)
+        for _, k, i in group:
+            evrs[k] = manifests[k].evr(i)
+        yield name, evrs
+
+
+def make_package_info(pkgs: Manifest, parent_pkgs: Manifest | None) -> dict[str, list]:
+    installed = [pkg.to_dict() for pkg in pkgs.packages()]
+    [updated, new, removed] = [[]] * 3
+
+    if parent_pkgs is not None:
+        new = [pkg.to_dict() for pkg in get_unique_packages(pkgs, parent_pkgs)]
+        removed = [pkg.to_dict() for pkg in get_unique_packages(parent_pkgs, pkgs)]
+        updated = [diff.to_dict() for diff in get_update_diff_list(pkgs, parent_pkgs)]
+
+    return {
+        "installed": installed,
+        "new": new,
+        "removed": removed,
+        "updated": updated,
+    }
+
+
+def make_metadata(
+    stream: altcos.Stream,
+    commit: altcos.Commit,
+    parent: altcos.Commit | None,
+    pkgs: Manifest,
+    parent_pkgs: Manifest | None,
+) -> dict[str, typing.Any]:
+    return {
+        "reference": str(stream),
+        "version": str(commit.version),
+        "description": str(commit.description),
+        "commit": str(commit),
+        "parent": str(parent) if parent else None,
+        "package_info": make_package_info(pkgs, parent_pkgs),
+    }
+
+
+def get_commit_chain(commit: altcos.Commit, count: int | None) -> list[altcos.Commit]:
+    """return `count` (all if None) commits from `commit` back to the root
+
+    The parent of the oldest one is included too: it is needed for its diff.
+    """
+
+    chain = [commit]
+    while count is None or len(chain) <= count:
+        if (parent := chain[-1].parent) is None:
+            break
+        chain.append(parent)
+
+    return chain
+
+
+@functools.cache
+def open_repository(repo_root: str, stream: str, mode: str) -> altcos.Repository:
+    return altcos.Repository(altcos.Stream.from_str(repo_root, stream), mode).open()
+
+
+def read_commit_packages(
+    repo_root: str, stream: str, mode: str, cache: ManifestCache | None, hashsum: str
+) -> Manifest:
+    """read the commit packages in a worker process (OSTree objects are not picklable)"""
+
+    commit = altcos.Commit(open_repository(repo_root, stream, mode), hashsum)
+    return read_packages(commit, cache)
+
+
+def collect_metadata(
+    stream: altcos.Stream,
+    chain: list[altcos.Commit],
+    count: int | None,
+    cache: ManifestCache | None,
+    jobs: int,
+) -> typing.Iterator[
+    tuple[altcos.Commit, Manifest, Manifest | None, dict[str, typing.Any]]
+]:
+    """yield the chain commits with their and parent manifests and metadata, oldest first
+
+    Every rpmdb is parsed once (in parallel with `jobs` > 1) and only the
+    manifests of the two adjacent commits are kept. The parents go first,
+    so the delta store always has the parent record of a commit.
+    """
+
+    read = functools.partial(
+        read_commit_packages, stream.repo_root, str(stream), chain[0].repo.mode, cache
+    )
+    commits = chain[:count]
+    hashsums = [str(commit) for commit in reversed(chain)]
+
+    with contextlib.ExitStack() as stack:
+        if jobs > 1 and len(chain) > 1:
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(jobs))
+            manifests = pool.map(read, hashsums)
+        else:
+            manifests = map(read, hashsums)
+
+        # the parent of the oldest commit is only read for its diff
+        parent = chain[len(commits)] if len(chain) > len(commits) else None
+        parent_pkgs = next(manifests) if parent is not None else None
+
+        for commit in reversed(commits):
+            pkgs = next(manifests)
+
+            metadata = make_metadata(stream, commit, parent, pkgs, parent_pkgs)
+            yield commit, pkgs, parent_pkgs, metadata
+
+            parent, parent_pkgs = commit, pkgs
+
+
+def make_comparison(
+    revisions: list[str],
+    manifests: list[Manifest],
+    names: list[str] | None,
+    below: str | None,
+) -> list[dict[str, typing.Any]]:
+    """return the package versions of the revisions
+
+    `outdated` lists the revisions with an older version than the newest one,
+    `below` - the revisions with a version older than `below`.
+    """
+
+    if names is None:
+        entries = list(compare_manifests(manifests))
+    else:
+        entries = [
+            (name, [m.evr(i) if (i := m.index(name)) is not None else None for m in manifests])
+            for name in sorted(set(names))
+        ]
+
+    evrs = (evr for _, versions in entries for evr in versions if evr is not None)
+    ranks = rank_evrs(itertools.chain(evrs, [below] if below is not None else []))
+
+    comparison = []
+    for name, versions in entries:
+        present = [(rev, ranks[evr]) for rev, evr in zip(revisions, versions) if evr]
+        if not present:
+            continue
+
+        latest = max(rank for _, rank in present)
+        entry = {
+            "name": name,
+            "versions": dict(zip(revisions, versions)),
+            "outdated": [rev for rev, rank in present if rank < latest],
+        }
+
+        if below is not None:
+            entry["below"] = [rev for rev, rank in present if rank < ranks[below]]
+            if not entry["below"]:
+                continue
+
+        comparison.append(entry)
+
+    return comparison
+
+
+def resolve_commit(repo: altcos.Repository, rev: str) -> altcos.Commit | None:
+    """return the commit by "latest", checksum or ref (e.g. another stream)"""
 
+    if rev == "latest":
+        return repo.last_commit()
 
-def get_unique_packages(a: PackageMapping, b: PackageMapping) -> PackageMapping:
-    unique_names = set(a.keys()).difference(set(b.keys()))
-    return {n: a[n] for n in unique_names}
+    if (commit := altcos.Commit(repo, rev)).exists():
+        return commit
+
+    try:
+        hashsum = repo.storage.resolve_rev(rev, True)[1]
+    except GLib.Error:
+        return None
+
+    return altcos.Commit(repo, hashsum) if hashsum else None
+
+
+def write_metadata(
+    stream: altcos.Stream,
+    commit: altcos.Commit,
+    metadata: dict[str, typing.Any],
+    indent: int | None,
+) -> None:
+    metadata_path = stream.vars_dir.joinpath(commit.version.like_path, "metadata.json")
+    with open(metadata_path, "w") as file:
+        json.dump(metadata, file, indent=indent)
 
 
 def main() -> None:
@@ -160,6 +755,59 @@ def main() -> None:
         action="store_true",
         help="Write metadata to the version directory.",
     )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Write the package lists to the delta store instead of metadata.json.",
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Make metadata.json from the delta store instead of the rpmdb.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the package manifests cache.",
+    )
+    scope = parser.add_mutually_exclusive_group()
+    scope.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        help="Collect metadata of the commit and its ancestors (a list is printed).",
+    )
+    scope.add_argument(
+        "--all",
+        action="store_true",
+        help="Collect metadata of the commit and all its ancestors (a list is printed).",
+    )
+    scope.add_argument(
+        "-c",
+        "--compare",
+        nargs="+",
+        metavar="REV",
+        help="Compare package versions of the commit and other commits or refs.",
+    )
+    parser.add_argument(
+        "-p",
+        "--package",
+        action="append",
+        help="Package to compare (all by default, may be repeated).",
+    )
+    parser.add_argument(
+        "-b",
+        "--below",
+        metavar="EVR",
+        help="Compare only the packages older than [epoch:]version-release somewhere.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes reading the rpmdb in the history and compare modes.",
+    )
     args = parser.parse_args()
 
     stream = altcos.Stream.from_str(args.repo_root, args.stream)
@@ -168,49 +816,78 @@ def main() -> None:
         logger.fatal(f'failed to open "{repo.path}" repository')
         sys.exit(1)
 
-    if args.commit == "latest":
-        if not (commit := repo.last_commit()):
-            logger.fatal(f'failed to get latest commit')
+    revisions = [args.commit, *(args.compare or [])]
+    commits = []
+    for rev in revisions:
+        if (commit := resolve_commit(repo, rev)) is None:
+            logger.fatal(f'failed to get "{rev}" commit')
             sys.exit(1)
-    else:
-        if not (commit := altcos.Commit(repo, args.commit)).exists():
-            logger.fatal(f'failed to get "{commit}" commit')
-            sys.exit(1)
-
-    pkgs = BDBReader.from_ostree_commit(commit).read()
-    installed = [pkg.to_dict() for pkg in pkgs.values()]
-    [updated, new, removed] = [[]] * 3
-
-    if (parent := commit.parent) is not None:
-        parent_pkgs = BDBReader.from_ostree_commit(parent).read()
-        new = [pkg.to_dict() for pkg in get_unique_packages(pkgs, parent_pkgs).values()]
-        removed = [
-            pkg.to_dict() for pkg in get_unique_packages(parent_pkgs, pkgs).values()
-        ]
-        updated = [diff.to_dict() for diff in get_update_diff_list(pkgs, parent_pkgs)]
+        commits.append(commit)
 
-    metadata = {
-        "reference": str(stream),
-        "version": str(commit.version),
-        "description": str(commit.description),
-        "commit": str(commit),
-        "parent": str(parent) if parent else None,
-        "package_info": {
-            "installed": installed,
-            "new": new,
-            "removed": removed,
-            "updated": updated,
-        },
-    }
+    commit = commits[0]
+    cache = None if args.no_cache else ManifestCache.for_stream(stream)
 
-    if args.write:
-        metadata_path = stream.vars_dir.joinpath(
-            commit.version.like_path, "metadata.json"
+    if args.compare:
+        read = functools.partial(
+            read_commit_packages, stream.repo_root, str(stream), repo.mode, cache
         )
-        with open(metadata_path, "w") as file:
-            json.dump(metadata, file, indent=args.indent)
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+            try:
+                manifests = list(pool.map(read, map(str, commits)))
+            except ManifestError as e:
+                logger.fatal(e)
+                sys.exit(1)
+
+        comparison = make_comparison(revisions, manifests, args.package, args.below)
+        print(json.dumps(comparison, indent=args.indent))
+        return
+
+    if history := args.all or args.count is not None:
+        count = None if args.all else args.count
+        jobs = args.jobs
     else:
-        print(json.dumps(metadata, indent=args.indent))
+        count = 1
+        jobs = 1
+
+    chain = get_commit_chain(commit, count)
+    store = MetadataStore.for_stream(stream)
+
+    if args.export:
+        metadata = []
+        for commit in chain[:count]:
+            if (entry := store.metadata(str(commit))) is None:
+                logger.fatal(f'"{commit}" commit is not in the delta store')
+                sys.exit(1)
+            metadata.append((commit, entry))
+
+        if args.write:
+            for commit, entry in metadata:
+                write_metadata(stream, commit, entry, args.indent)
+        elif history:
+            print(json.dumps([entry for _, entry in metadata], indent=args.indent))
+        else:
+            print(json.dumps(metadata[0][1], indent=args.indent))
+        return
+
+    metadata = collect_metadata(stream, chain, count, cache, jobs)
+
+    try:
+        if args.write:
+            with PackageIndex.for_repository(stream.repo_root) as index:
+                for commit, pkgs, parent_pkgs, entry in metadata:
+                    if args.delta:
+                        store.add(entry, pkgs, parent_pkgs)
+                    else:
+                        write_metadata(stream, commit, entry, args.indent)
+                    index.add(stream, commit, pkgs)
+        elif history:
+            entries = [entry for *_, entry in metadata]
+            print(json.dumps(entries[::-1], indent=args.indent))
+        else:
+            print(json.dumps(next(metadata)[-1], indent=args.indent))
+    except ManifestError as e:
+        logger.fatal(e)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
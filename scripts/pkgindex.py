@@ -0,0 +1,156 @@
+"""Package -> image index of the repository
+
+Kept apart from pkgdiff.py, so `pkgquery.py` does not load altcos and gi.
+"""
+
+from __future__ import annotations
+
+import functools
+import os
+import pathlib
+import sqlite3
+import typing
+
+import rpm
+
+if typing.TYPE_CHECKING:
+    import altcos
+    from pkgdiff import Manifest
+
+
+def split_evr(evr: str) -> tuple[str | None, str, str | None]:
+    """split "[epoch:]version[-release]", the release is None if absent"""
+
+    epoch, _, vr = evr.rpartition(":")
+    version, dash, release = vr.rpartition("-")
+    if not dash:
+        return epoch or None, vr, None
+    return epoch or None, version, release
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def compare_evr(a: str, b: str) -> int:
+    """compare the EVRs, the release is skipped if any of them has none"""
+
+    if a == b:
+        return 0
+
+    a_evr, b_evr = split_evr(a), split_evr(b)
+    if a_evr[2] is None or b_evr[2] is None:
+        a_evr, b_evr = (*a_evr[:2], None), (*b_evr[:2], None)
+
+    return rpm.labelCompare(a_evr, b_evr)
+
+
+class PackageIndex:
+    """package -> image reverse index of the repository
+
+    One SQLite database at the repository root keeps the package EVRs of
+    every indexed commit of all branches, arches and streams, so the images
+    with a package (version) are found without reading the metadata files.
+    EVRs are compared by rpm with the `rpmevr` collation.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY,
+            stream TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            arch TEXT NOT NULL,
+            name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            date TEXT NOT NULL,
+            major INTEGER NOT NULL,
+            minor INTEGER NOT NULL,
+            commit_ TEXT NOT NULL,
+            UNIQUE (stream, commit_)
+        );
+        CREATE TABLE IF NOT EXISTS packages (
+            image INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            evr TEXT NOT NULL COLLATE rpmevr
+        );
+        CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+        CREATE INDEX IF NOT EXISTS packages_image ON packages (image);
+    """
+
+    def __init__(self, path: str | os.PathLike) -> None:
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.create_collation("rpmevr", compare_evr)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(self.SCHEMA)
+
+    def __enter__(self) -> PackageIndex:
+        return self
+
+    def __exit__(self, *exc: typing.Any) -> None:
+        self.db.close()
+
+    @classmethod
+    def for_repository(cls, repo_root: str | os.PathLike) -> PackageIndex:
+        return cls(pathlib.Path(repo_root, "packages.db"))
+
+    def add(self, stream: altcos.Stream, commit: altcos.Commit, manifest: Manifest) -> None:
+        version = commit.version
+
+        with self.db:
+            self.db.execute(
+                "DELETE FROM images WHERE stream = ? AND commit_ = ?", (str(stream), str(commit))
+            )
+            image = self.db.execute(
+                "INSERT INTO images "
+                "(stream, branch, arch, name, version, date, major, minor, commit_) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(stream),
+                    stream.branch,
+                    stream.arch,
+                    stream.name,
+                    str(version),
+                    version.date,
+                    version.major,
+                    version.minor,
+                    str(commit),
+                ),
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO packages (image, name, evr) VALUES (?, ?, ?)",
+                ((image, name, manifest.evr(i)) for i, name in enumerate(manifest.names)),
+            )
+
+    def find(
+        self,
+        name: str,
+        op: str | None = None,
+        evr: str | None = None,
+        branch: str | None = None,
+        arch: str | None = None,
+        stream: str | None = None,
+    ) -> list[sqlite3.Row]:
+        """return the images with the package, oldest first by stream
+
+        `op` (<, <=, =, >=, >) compares the package EVR with `evr`, the
+        images may be narrowed by the branch, arch and stream name.
+        """
+
+        query = (
+            "SELECT images.*, packages.evr FROM packages "
+            "JOIN images ON images.id = packages.image WHERE packages.name = ?"
+        )
+        params: list[typing.Any] = [name]
+
+        if op is not None:
+            if op not in ("<", "<=", "=", ">=", ">"):
+                raise ValueError(f'invalid operator "{op}"')
+            query += f" AND packages.evr {op} ?"
+            params.append(evr)
+
+        for column, value in (("branch", branch), ("arch", arch), ("name", stream)):
+            if value is not None:
+                query += f" AND images.{column} = ?"
+                params.append(value)
+
+        query += " ORDER BY images.stream, images.date, images.major, images.minor"
+
+        return self.db.execute(query, params).fetchall()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Queries the package -> image index written by `pkgdiff.py --write`"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import pathlib
+import re
+import sqlite3
+import sys
+import typing
+
+import colorlog
+from pkgindex import PackageIndex, split_evr
+
+logger = colorlog.get_logger(__name__, logging.StreamHandler(), fmt="%(message)s")
+
+SPEC_RE = re.compile(r"^([^<>=\s]+)\s*(?:(<=|>=|<|>|=)\s*(\S+))?$")
+
+
+def parse_spec(spec: str) -> tuple[str, str | None, str | None]:
+    """split "name[<op>evr]" (e.g. "openssl<3.1.0-alt1", "openssl>=1:3.1")"""
+
+    if (match := SPEC_RE.match(spec)) is None:
+        raise ValueError(f'invalid package spec "{spec}"')
+
+    name, op, evr = match.groups()
+    if evr is not None:
+        # "ver", "epoch:ver" or "[epoch:]ver-rel", a missing release is not compared
+        epoch, version, release = split_evr(evr)
+        if (
+            not version
+            or release == ""
+            or (epoch is not None and not epoch.isdigit())
+            or evr.startswith(":")
+        ):
+            raise ValueError(f'invalid [epoch:]version[-release] "{evr}" in "{spec}"')
+
+    return name, op, evr
+
+
+def get_artifacts(storage: pathlib.Path | None, image: sqlite3.Row) -> list[str]:
+    if storage is None:
+        return []
+
+    version_dir = storage.joinpath(image["branch"], image["arch"], image["name"], image["version"])
+    return sorted(str(path) for path in version_dir.glob("*/*/*") if path.is_file())
+
+
+def make_entry(image: sqlite3.Row, storage: pathlib.Path | None) -> dict[str, typing.Any]:
+    return {
+        "stream": image["stream"],
+        "version": image["version"],
+        "commit": image["commit_"],
+        "evr": image["evr"],
+        "artifacts": get_artifacts(storage, image),
+    }
+
+
+def first_versions(images: list[sqlite3.Row]) -> list[sqlite3.Row]:
+    """return the first version of every stream (the images are ordered)"""
+
+    first = {}
+    for image in images:
+        first.setdefault(image["stream"], image)
+    return list(first.values())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Finds the images with a package.")
+    parser.add_argument("repo_root", help="ALTCOS repository root")
+    parser.add_argument(
+        "package",
+        help='Package name with an optional [epoch:]version-release condition '
+        '(e.g. "openssl", "openssl<3.1.0-alt1")',
+    )
+    parser.add_argument(
+        "--first",
+        action="store_true",
+        help="Print only the first version of every stream which matches.",
+    )
+    parser.add_argument("--branch", help="Only the images of the branch")
+    parser.add_argument("--arch", help="Only the images of the arch")
+    parser.add_argument("--stream", help="Only the images of the stream name (e.g. base)")
+    parser.add_argument("--storage", type=pathlib.Path, help="Builds storage root to list artifacts")
+    parser.add_argument("-f", "--format", choices=["text", "json"], default="text")
+    parser.add_argument("-i", "--indent", type=int)
+
+    args = parser.parse_args()
+
+    try:
+        name, op, evr = parse_spec(args.package)
+    except ValueError as e:
+        logger.fatal(e)
+        sys.exit(1)
+
+    if not (path := pathlib.Path(args.repo_root, "packages.db")).exists():
+        logger.fatal(f'index "{path}" does not exist (run pkgdiff.py with --write)')
+        sys.exit(1)
+
+    with PackageIndex(path) as index:
+        images = index.find(name, op, evr, args.branch, args.arch, args.stream)
+
+    if args.first:
+        images = first_versions(images)
+
+    entries = [make_entry(image, args.storage) for image in images]
+
+    if args.format == "json":
+        print(json.dumps(entries, indent=args.indent))
+        return
+
+    for entry in entries:
+        print(entry["stream"], entry["version"], entry["commit"], f"{name}-{entry['evr']}")
+        for artifact in entry["artifacts"]:
+            print(f"  {artifact}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Compresses, hashes and signs the images in a single read
+
+`compress.sh` and `sign.sh` read an image three times (xz, the signature
+of the image and the signature of the `.xz`). Here the image is read once:
+every block goes to the sha256 of the image and to the compressor, its
+output goes to the compressed file and its own sha256, and both digests
+are signed. The artifacts of several platforms/formats are processed in
+parallel. The codec of an artifact is chosen as in compression.py.
+"""
+
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import pathlib
+import subprocess
+import sys
+import tempfile
+import typing
+
+import altcos
+import compression
+
+import colorlog
+
+logger = colorlog.get_logger(__name__, logging.StreamHandler(), fmt="%(message)s")
+
+BLOCK_SIZE = 1 << 22
+
+
+class PostprocessError(Exception):
+    pass
+
+
+def get_image(
+    storage: pathlib.Path,
+    stream: altcos.Stream,
+    version: altcos.Version,
+    platform: altcos.Platform,
+    fmt: altcos.Format,
+) -> pathlib.Path:
+    """return the image path (as `get_artifact_dir` of utils.sh)"""
+
+    build_dir = storage.joinpath(
+        stream.branch, stream.arch, stream.name, str(version), platform, fmt
+    )
+    return build_dir.joinpath(
+        f"{stream.branch}_{stream.name}.{stream.arch}.{version}.{platform}.{fmt}"
+    )
+
+
+def sign(digest: bytes, key: pathlib.Path, path: pathlib.Path) -> None:
+    """sign the sha256 digest (the same signature as `openssl dgst -sha256 -sign`)"""
+
+    proc = subprocess.run(
+        ["openssl", "pkeyutl", "-sign", "-inkey", str(key), "-pkeyopt", "digest:sha256", "-out", str(path)],
+        input=digest,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode != 0:
+        raise PostprocessError(f'failed to sign "{path}": {proc.stderr.decode().strip()}')
+
+
+def compress(
+    image: pathlib.Path, compressed: pathlib.Path, cmd: list[str]
+) -> tuple[bytes, bytes]:
+    """compress the image and return the digests of the image and the result"""
+
+    raw, packed = hashlib.sha256(), hashlib.sha256()
+    tmp = compressed.with_name(f".{compressed.name}.tmp")
+
+    def drain(proc: subprocess.Popen, file: typing.BinaryIO) -> None:
+        while block := proc.stdout.read(BLOCK_SIZE):
+            packed.update(block)
+            file.write(block)
+
+    try:
+        with (
+            open(image, "rb", buffering=0) as src,
+            open(tmp, "wb") as dst,
+            tempfile.TemporaryFile() as stderr,
+            subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr
+            ) as proc,
+            concurrent.futures.ThreadPoolExecutor(1) as reader,
+        ):
+            drained = reader.submit(drain, proc, dst)
+            try:
+                while block := src.read(BLOCK_SIZE):
+                    raw.update(block)
+                    proc.stdin.write(block)
+            except BrokenPipeError:
+                # the compressor has died, its return code tells why
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+            drained.result()
+            proc.wait()
+
+            if proc.returncode != 0:
+                stderr.seek(0)
+                error = stderr.read().decode(errors="replace").strip()
+                raise PostprocessError(
+                    f'failed to compress "{image}" ({proc.returncode}): {error}'
+                )
+
+        tmp.replace(compressed)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    return raw.digest(), packed.digest()
+
+
+def process(
+    image: pathlib.Path, key: pathlib.Path, keep: bool, spec: str
+) -> dict[str, typing.Any]:
+    codec, level = compression.parse_spec(spec)
+    compressed = image.with_name(image.name + codec.suffix)
+
+    raw, packed = compress(image, compressed, codec.compress_args(level))
+
+    sign(raw, key, image.with_name(image.name + ".sig"))
+    sign(packed, key, compressed.with_name(compressed.name + ".sig"))
+
+    if not keep:
+        image.unlink()
+
+    return {
+        "image": str(image),
+        "compression": f"{codec.name}:{level}",
+        "sha256": raw.hex(),
+        "compressed": str(compressed),
+        "compressed_sha256": packed.hex(),
+    }
+
+
+def main() -> None:
+    api = "$stream $repo_root $commit $storage $key $artifacts"
+
+    if len(sys.argv) == 2 and sys.argv[1] in ["-a", "--api"]:
+        print(api, end="")
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description="Compresses, hashes and signs the images in a single read."
+    )
+    parser.add_argument("stream", help="ALTCOS stream (e.g. altcos/x86_64/sisyphus/base)")
+    parser.add_argument("repo_root", help="ALTCOS repository root")
+    parser.add_argument("commit", help='Commit hashsum or "latest"')
+    parser.add_argument("storage", type=pathlib.Path, help="Image storage root")
+    parser.add_argument("key", type=pathlib.Path, help="Key for sign")
+    parser.add_argument(
+        "artifacts", nargs="+", help="<platform>/<format> of the images (e.g. qemu/qcow2)"
+    )
+    parser.add_argument(
+        "-k", "--keep", action="store_true", help="Keep the uncompressed images"
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="Images processed in parallel")
+    parser.add_argument(
+        "-c",
+        "--compression",
+        help="Codec spec of all the images (e.g. zstd:19), see compression.py",
+    )
+    args = parser.parse_args()
+
+    if not args.key.is_file():
+        logger.fatal(f'"{args.key}" key file does not exists')
+        sys.exit(1)
+
+    stream = altcos.Stream.from_str(args.repo_root, args.stream)
+
+    if not (repo := altcos.Repository(stream, altcos.Repository.Mode.BARE)).exists():
+        logger.fatal(f'failed to open "{repo.path}" repository')
+        sys.exit(1)
+
+    if args.commit == "latest":
+        if not (commit := repo.last_commit()):
+            logger.fatal("failed to get latest commit")
+            sys.exit(1)
+    else:
+        if not (commit := altcos.Commit(repo, args.commit)).exists():
+            logger.fatal(f'failed to get "{commit}" commit')
+            sys.exit(1)
+
+    version = commit.version
+    images = []
+    specs = []
+    for artifact in args.artifacts:
+        try:
+            platform, fmt = artifact.split("/")
+            image = get_image(
+                args.storage, stream, version, altcos.Platform(platform), altcos.Format(fmt)
+            )
+        except ValueError:
+            logger.fatal(f'invalid artifact "{artifact}" (expected <platform>/<format>)')
+            sys.exit(1)
+
+        if not image.is_file():
+            logger.fatal(f'image "{image}" does not exist')
+            sys.exit(1)
+
+        spec = args.compression or compression.get_spec(platform, fmt)
+        try:
+            compression.parse_spec(spec)
+            compression.check_standalone(image)
+        except compression.CompressionError as e:
+            logger.fatal(e)
+            sys.exit(1)
+
+        images.append(image)
+        specs.append(spec)
+
+    key = args.key.resolve()
+    with concurrent.futures.ThreadPoolExecutor(args.jobs or len(images)) as pool:
+        try:
+            results = list(
+                pool.map(lambda image, spec: process(image, key, args.keep, spec), images, specs)
+            )
+        except PostprocessError as e:
+            logger.fatal(e)
+            sys.exit(1)
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -38,11 +38,10 @@ mode=$3
 commit=$4
 
 check_args stream repo_root mode commit
-check_stream "$stream" "$repo_root"
+describe_stream "$stream" "$repo_root" "$mode" "$commit"
+require_envs COMMIT
 
-export_stream "$stream" "$repo_root" "$mode"
-
-commit="$(get_commit "$stream" "$repo_root" "$mode" "$commit")"
+commit="$COMMIT"
 
 src_ostree_dir="$(get_ostree_dir "$stream" "$repo_root" "$mode")"
 if [ "$mode" = "bare" ]; then
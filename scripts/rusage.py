@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""Writes the rusage of the waited children and exits with their return code
+
+    sh -c 'service args
+    exec python3 -S -I rusage.py <file> "$?"'
+
+A process forked from Python starts with the Python RSS in its `ru_maxrss`.
+So the services are started by a small shell, and the shell execs this
+script once the service has exited: the children rusage survives exec and
+covers only the service and its descendants.
+"""
+
+import json
+import resource
+import sys
+
+FIELDS = ("ru_utime", "ru_stime", "ru_maxrss", "ru_inblock", "ru_oublock")
+
+
+def main() -> None:
+    path, returncode = sys.argv[1], int(sys.argv[2])
+
+    rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(path, "w") as file:
+        json.dump({field: getattr(rusage, field) for field in FIELDS}, file)
+
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
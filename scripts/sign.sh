@@ -51,16 +51,11 @@ if [ ! -f "$key" ]; then
     exit 1
 fi
 
-check_stream "$stream" "$repo_root"
-export_stream "$stream" "$repo_root"
+describe_stream "$stream" "$repo_root" bare "$commit"
+require_envs COMMIT
 
-commit="$(get_commit "$stream" "$repo_root" "bare" "$commit")"
-
-version="$(python3 "$__dir"/../stream.py \
-    "$stream" \
-    "$repo_root" \
-    version \
-    --commit "$commit")"
+commit="$COMMIT"
+version="$VERSION"
 
 build_dir="$(get_artifact_dir \
     "$stream" \
@@ -71,10 +66,21 @@ build_dir="$(get_artifact_dir \
     "$storage")"
 
 image_file="$build_dir"/"$BRANCH"_"$NAME"."$ARCH"."$version"."$platform"."$format"
-compressed="$image_file".xz
+# compression.py removes the image, the compressed file has the codec suffix
+mapfile -t compressed < <(python3 "$__dir"/compression.py compressed "$image_file" 2>/dev/null)
 
-for file in $image_file $compressed; do
+files=()
+for file in "$image_file" "${compressed[@]}"; do
     if [ -f "$file" ]; then
-        openssl dgst -sha256 -sign "$key" -out "$file".sig "$file"
+        files+=("$file")
     fi
 done
+
+if [ "${#files[@]}" -eq 0 ]; then
+    fatal "image \"$image_file\" does not exist"
+    exit 1
+fi
+
+for file in "${files[@]}"; do
+    openssl dgst -sha256 -sign "$key" -out "$file".sig "$file"
+done
@@ -0,0 +1,46 @@
+#!/usr/bin/env bash
+
+set -eo pipefail
+
+__dir=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+__name="$(basename "$0")"
+
+# shellcheck disable=SC1091
+source "$__dir"/utils.sh
+
+# shellcheck disable=SC2034
+usage="Usage: $__name [options] <lines> <width> <sleep>
+Stub service for the orchestrator benchmarks
+
+Arguments:
+    lines - number of the output lines (e.g. \"1000\")
+    width - output line width (e.g. \"80\")
+    sleep - run time in seconds (e.g. \"0.1\")
+    Options:
+        -a, --api - print API-like arguments (e.g. \"\$stream \$repo-root\")
+        -h, --help - print this message"
+
+
+need_api=0
+handle_options "$@"
+if [ "$need_api" -eq 1 ]; then
+    echo -n "\$lines" "\$width" "\$sleep"
+    exit
+fi
+
+lines=$1
+width=$2
+sleep=$3
+
+check_args lines width sleep
+
+if [ "$lines" -gt 0 ]; then
+    # "yes" is killed by SIGPIPE once "head" has enough lines
+    set +o pipefail
+    yes "$(printf "%${width}s" "" | tr " " x)" | head -n "$lines"
+    set -o pipefail
+fi
+
+if [ "$sleep" != 0 ]; then
+    sleep "$sleep"
+fi
@@ -3,6 +3,7 @@
 __dir=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 
 RED=$(tput setaf 1)
+YELLOW=$(tput setaf 3)
 RESET=$(tput sgr0)
 
 fatal() {
@@ -13,6 +14,14 @@ fatal() {
 	fi
 }
 
+warn() {
+	if test -t 1; then
+		echo "${YELLOW}warning:$RESET $*" 1>&2
+	else
+		echo "warning: $*" 1>&2
+	fi
+}
+
 check_root_uid() {
     [ $UID -eq 0 ] || {
         fatal "$(basename "$0") needs to be run as root (uid=0) only"
@@ -35,13 +44,39 @@ check_args() {
     done
 }
 
+# Run stream.py, through the stream metadata daemon ("stream.py serve")
+# if ALTCOS_STREAM_SOCKET points to it, to skip the interpreter start-up
+stream_py() {
+    local response=
+
+    if [ -S "$ALTCOS_STREAM_SOCKET" ] && command -v socat &> /dev/null; then
+        if response="$(printf '%s\0' "$@" \
+            | socat -t 60 - UNIX-CONNECT:"$ALTCOS_STREAM_SOCKET" 2>/dev/null)" \
+            && [ -n "$response" ]; then
+            # the answer is "<returncode>\n<output>", the output of a failed
+            # query is an error message
+            local returncode="${response%%$'\n'*}"
+            if [[ "$response" == *$'\n'* ]]; then
+                if [ "$returncode" -eq 0 ]; then
+                    echo "${response#*$'\n'}"
+                else
+                    echo "${response#*$'\n'}" 1>&2
+                fi
+            fi
+            return "$returncode"
+        fi
+    fi
+
+    python3 "$__dir"/../stream.py "$@"
+}
+
 check_stream() {
     local stream=$1
     local repo_root=$2
 
     local output=
 
-    output="$(python3 "$__dir"/../stream.py "$stream" "$repo_root" 2>&1)" || {
+    output="$(stream_py "$stream" "$repo_root" 2>&1)" || {
         fatal "$output"
         exit 1
     }
@@ -52,7 +87,7 @@ export_stream() {
     local repo_root=$2
     local mode=${3:-bare}
 
-    output="$(python3 "$__dir"/../stream.py "$stream" "$repo_root" --mode "$mode" 2>&1)" || {
+    output="$(stream_py "$stream" "$repo_root" --mode "$mode" 2>&1)" || {
         fatal "$output"
         exit 1
     }
@@ -91,6 +126,29 @@ handle_options() {
     done
 }
 
+# Export the stream variables, the resolved commit (COMMIT, PARENT_COMMIT) and
+# its versions (VERSION, NEXT_MAJOR, NEXT_MINOR with _FULL and _PATH views)
+# with a single stream.py call
+describe_stream() {
+    local stream=$1
+    local repo_root=$2
+    local mode=${3:-bare}
+    local commit=${4:-latest}
+
+    output="$(stream_py \
+        "$stream" \
+        "$repo_root" \
+        --mode "$mode" \
+        describe \
+        --commit "$commit" 2>&1)" || {
+        fatal "$output"
+        exit 1
+    }
+
+    eval "$output"
+    described_stream="$stream"
+}
+
 get_apt_repo_namespace() {
     local branch=$1
     local ns=alt
@@ -232,7 +290,7 @@ get_commit() {
 
 		if [ "$commit" = "latest" ]; then
             set +e
-			python3 "$__dir"/../stream.py \
+			stream_py \
 				"$stream" \
 				"$repo_root" \
 				--mode "$mode" \
@@ -265,13 +323,44 @@ get_artifact_dir() {
 	check_artifact "$platform" "$format"
 
 	(
-		eval "$(export_stream "$stream" "$repo_root")"
+		# the stream variables are already exported by describe_stream
+		if [ "$described_stream" != "$stream" ]; then
+			eval "$(export_stream "$stream" "$repo_root")"
+		fi
 
 		# shellcheck disable=2153
 		echo "$storage"/"$BRANCH"/"$ARCH"/"$NAME"/"$version"/"$platform"/"$format"
 	)
 }
 
+# attach the qcow2 image to a free nbd device and print the device
+attach_qcow2() {
+	local image=$1
+	local sys_dev dev
+
+	modprobe nbd max_part=16 2>/dev/null || return 1
+
+	for sys_dev in /sys/block/nbd*; do
+		# the pid file exists while the device is connected
+		[ -e "$sys_dev"/pid ] && continue
+
+		dev=/dev/"$(basename "$sys_dev")"
+		# the freed and zeroed blocks are unmapped, so the image stays compact
+		if qemu-nbd \
+			--format=qcow2 \
+			--discard=unmap \
+			--detect-zeroes=unmap \
+			--connect="$dev" \
+			"$image" >/dev/null 2>&1; then
+			udevadm settle
+			echo "$dev"
+			return
+		fi
+	done
+
+	return 1
+}
+
 prepare_apt_dirs() {
 	local root_dir=$1
 
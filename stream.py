@@ -1,18 +1,149 @@
 #!/usr/bin/env python3
 import abc
 import argparse
+import contextlib
+import dataclasses
 import datetime
+import io
+import json
 import logging
+import os
+import pathlib
+import shlex
+import socketserver
 import sys
+import threading
+import typing
 
 import altcos
-from gi.repository import GLib
+from gi.repository import GLib, OSTree
 
 import colorlog
 
 logger = colorlog.get_logger(__name__, logging.StreamHandler(), fmt="%(message)s")
 
 
+class RepositoryCache:
+    """opened repositories of the daemon, reopened when the stream ref changes"""
+
+    def __init__(self) -> None:
+        self._entries: dict[tuple[str, str, str], tuple[typing.Any, altcos.Repository]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stamp(stream: altcos.Stream, mode: str) -> typing.Any:
+        """return the stream ref state, it changes with every new commit"""
+
+        path = altcos.Repository(stream, mode).path.joinpath("refs", "heads", str(stream))
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def get(self, stream: altcos.Stream, mode: str) -> altcos.Repository:
+        key = (stream.repo_root, str(stream), str(mode))
+        stamp = self.stamp(stream, mode)
+
+        with self._lock:
+            if (entry := self._entries.get(key)) is None or entry[0] != stamp:
+                entry = self._entries[key] = (stamp, altcos.Repository(stream, mode).open())
+
+        return entry[1]
+
+
+# set by the daemon, the one-shot calls open the repository every time
+REPOSITORIES: RepositoryCache | None = None
+
+
+def open_repository(stream: altcos.Stream, mode: str) -> altcos.Repository:
+    if REPOSITORIES is not None:
+        return REPOSITORIES.get(stream, mode)
+    return altcos.Repository(stream, mode).open()
+
+
+class CommitIndex:
+    """on-disk index of the stream commits
+
+    Maps commit -> version, parent, timestamp and description, and
+    version -> commit, so the history lookups do not walk the OSTree
+    parents one by one. The index is extended incrementally: only the
+    commits between the ref head and the last indexed head are read.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.head: str | None = None
+        self.commits: dict[str, dict[str, typing.Any]] = {}
+        self.versions: dict[str, str] = {}
+
+        try:
+            content = json.loads(path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            # a broken index is rebuilt from the repository
+            return
+
+        self.head = content["head"]
+        self.commits = content["commits"]
+        self.versions = {c["version"]: h for h, c in self.commits.items()}
+
+    @classmethod
+    def for_stream(cls, stream: altcos.Stream) -> "CommitIndex":
+        return cls(stream.alt_dir.joinpath("commits.json"))
+
+    def update(self, repository: altcos.Repository) -> int:
+        """index the new commits of the stream and return their number"""
+
+        if (head := repository.last_commit()) is None or str(head) == self.head:
+            return 0
+
+        added = 0
+        commit = head
+        while commit is not None and str(commit) not in self.commits:
+            content = repository.storage.load_commit(str(commit))[1]
+            parent = commit.parent
+
+            entry = {
+                "version": commit.version.full,
+                "parent": str(parent) if parent else None,
+                "timestamp": OSTree.commit_get_timestamp(content),
+                "description": commit.description,
+            }
+            self.commits[str(commit)] = entry
+            self.versions[entry["version"]] = str(commit)
+
+            added += 1
+            commit = parent
+
+        self.head = str(head)
+        self.save()
+
+        return added
+
+    def save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"head": self.head, "commits": self.commits}))
+            tmp.replace(self.path)
+        except OSError as e:
+            # e.g. the index of the root services is read by a user
+            logger.warning(f'failed to save "{self.path}" index ({e})')
+
+    def history(self, limit: int | None = None) -> list[dict[str, typing.Any]]:
+        history = []
+        commit = self.head
+        # the walk stops at a commit missing from the index
+        while commit in self.commits and (limit is None or len(history) < limit):
+            entry = self.commits[commit]
+            history.append({"commit": commit, **entry})
+            commit = entry["parent"]
+        return history
+
+    def resolve(self, version: str) -> str | None:
+        return self.versions.get(version)
+
+
 class Handler(abc.ABC):
     @staticmethod
     @abc.abstractmethod
@@ -63,7 +194,7 @@ class VersionHandler(Handler):
             sys.exit(1)
 
         try:
-            repository = altcos.Repository(stream, args.mode).open()
+            repository = open_repository(stream, args.mode)
         except GLib.Error as e:
             logger.fatal(e)
             sys.exit(1)
@@ -87,16 +218,7 @@ class VersionHandler(Handler):
                 version = commit.version
 
         if args.next:
-            today = datetime.datetime.now().strftime("%Y%m%d")
-            if version.date != today:
-                version.date = today
-                version.major = version.minor = 0
-            else:
-                match args.next:
-                    case "major":
-                        version.major += 1
-                    case "minor":
-                        version.minor += 1
+            version = VersionHandler.next_version(version, args.next)
 
         print(VersionHandler.apply_view(version, args.view))
 
@@ -118,6 +240,23 @@ class VersionHandler(Handler):
         )
         parser.set_defaults(handle=VersionHandler.handle)
 
+    @staticmethod
+    def next_version(version: altcos.Version, part: str) -> altcos.Version:
+        version = dataclasses.replace(version)
+
+        today = datetime.datetime.now().strftime("%Y%m%d")
+        if version.date != today:
+            version.date = today
+            version.major = version.minor = 0
+        else:
+            match part:
+                case "major":
+                    version.major += 1
+                case "minor":
+                    version.minor += 1
+
+        return version
+
     @staticmethod
     def apply_view(version: altcos.Version, view: str) -> str:
         match view:
@@ -140,7 +279,7 @@ class CommitHandler(Handler):
             sys.exit(1)
 
         try:
-            repository = altcos.Repository(stream, args.mode).open()
+            repository = open_repository(stream, args.mode)
         except GLib.Error as e:
             logger.fatal(e)
             sys.exit(1)
@@ -156,7 +295,280 @@ class CommitHandler(Handler):
         parser.set_defaults(handle=CommitHandler.handle)
 
 
-def main() -> None:
+class DescribeHandler(Handler):
+    """everything the services ask stream.py about, in a single call"""
+
+    VIEWS = {"": "native", "_FULL": "full", "_PATH": "path"}
+
+    @staticmethod
+    def handle(args: argparse.Namespace) -> None:
+        try:
+            stream = altcos.Stream.from_str(args.repo_root, args.stream)
+        except ValueError as e:
+            logger.fatal(e)
+            sys.exit(1)
+
+        try:
+            repository = open_repository(stream, args.mode)
+        except GLib.Error as e:
+            logger.fatal(e)
+            sys.exit(1)
+
+        description = DescribeHandler.describe(stream, repository, args.commit)
+
+        if args.format == "json":
+            print(json.dumps(description))
+        else:
+            print(
+                "\n".join(
+                    f"export {name}={shlex.quote(value or '')}"
+                    for name, value in DescribeHandler.flatten(description).items()
+                )
+            )
+
+    @staticmethod
+    def describe(
+        stream: altcos.Stream, repository: altcos.Repository, commit: str
+    ) -> dict:
+        if commit == "latest":
+            commit = repository.last_commit()
+        elif not (commit := altcos.Commit(repository, commit)).exists():
+            logger.fatal(f'commit "{commit}" not found')
+            sys.exit(1)
+
+        exports = dict(
+            part.removeprefix("export ").split("=", 1)
+            for part in stream.export().split(";")
+        )
+
+        if commit is None:
+            version = parent = None
+            next_versions = {
+                part: altcos.Version(0, 0, stream.branch, stream.name)
+                for part in ("major", "minor")
+            }
+        else:
+            version = commit.version
+            parent = commit.parent
+            next_versions = {
+                part: VersionHandler.next_version(version, part)
+                for part in ("major", "minor")
+            }
+
+        def views(version: altcos.Version | None) -> dict[str, str] | None:
+            if version is None:
+                return None
+            return {
+                view: VersionHandler.apply_view(version, view)
+                for view in DescribeHandler.VIEWS.values()
+            }
+
+        return {
+            "stream": exports,
+            "commit": str(commit) if commit else None,
+            "parent": str(parent) if parent else None,
+            "version": views(version),
+            "next": {part: views(v) for part, v in next_versions.items()},
+        }
+
+    @staticmethod
+    def flatten(description: dict) -> dict[str, str | None]:
+        """return the shell variables of the description"""
+
+        variables = dict(description["stream"])
+        variables["COMMIT"] = description["commit"]
+        variables["PARENT_COMMIT"] = description["parent"]
+
+        for suffix, view in DescribeHandler.VIEWS.items():
+            version = description["version"]
+            variables[f"VERSION{suffix}"] = version[view] if version else None
+            for part, version in description["next"].items():
+                variables[f"NEXT_{part.upper()}{suffix}"] = version[view]
+
+        return variables
+
+    @staticmethod
+    def fill(parser: argparse.ArgumentParser) -> None:
+        parser.add_argument(
+            "-c",
+            "--commit",
+            default="latest",
+            help="Commit hashsum or \"latest\"",
+        )
+        parser.add_argument(
+            "-f",
+            "--format",
+            choices=["shell", "json"],
+            default="shell",
+            help="Output format",
+        )
+        parser.set_defaults(handle=DescribeHandler.handle)
+
+
+def open_index(args: argparse.Namespace) -> CommitIndex:
+    """return the up-to-date commit index of the stream"""
+
+    try:
+        stream = altcos.Stream.from_str(args.repo_root, args.stream)
+    except ValueError as e:
+        logger.fatal(e)
+        sys.exit(1)
+
+    try:
+        repository = open_repository(stream, args.mode)
+    except GLib.Error as e:
+        logger.fatal(e)
+        sys.exit(1)
+
+    index = CommitIndex.for_stream(stream)
+    index.update(repository)
+
+    return index
+
+
+class IndexHandler(Handler):
+    @staticmethod
+    def handle(args: argparse.Namespace) -> None:
+        print(len(open_index(args).commits))
+
+    @staticmethod
+    def fill(parser: argparse.ArgumentParser) -> None:
+        parser.set_defaults(handle=IndexHandler.handle)
+
+
+class HistoryHandler(Handler):
+    @staticmethod
+    def handle(args: argparse.Namespace) -> None:
+        history = open_index(args).history(args.limit)
+
+        if args.format == "json":
+            print(json.dumps(history))
+        else:
+            for entry in history:
+                print(entry["version"], entry["commit"])
+
+    @staticmethod
+    def fill(parser: argparse.ArgumentParser) -> None:
+        parser.add_argument("-n", "--limit", type=int, help="Number of the latest commits")
+        parser.add_argument(
+            "-f",
+            "--format",
+            choices=["text", "json"],
+            default="text",
+            help="Output format",
+        )
+        parser.set_defaults(handle=HistoryHandler.handle)
+
+
+class ResolveHandler(Handler):
+    @staticmethod
+    def handle(args: argparse.Namespace) -> None:
+        index = open_index(args)
+
+        version = args.version
+        if (commit := index.resolve(version)) is None:
+            # the native view (e.g. 20240101.0.0) of the stream version
+            stream = altcos.Stream.from_str(args.repo_root, args.stream)
+            commit = index.resolve(f"{stream.branch}_{stream.name}.{version}")
+
+        if commit is None:
+            logger.fatal(f'version "{version}" not found')
+            sys.exit(1)
+
+        print(commit)
+
+    @staticmethod
+    def fill(parser: argparse.ArgumentParser) -> None:
+        parser.add_argument("version", help="Version in the full or native view")
+        parser.set_defaults(handle=ResolveHandler.handle)
+
+
+class StreamDaemon:
+    """long-lived stream.py answering the queries from memory
+
+    A query is the stream.py command line, the answer is its exit code and
+    output. The answers are memoized until the stream ref changes (or the
+    day changes, for the `--next` versions).
+    """
+
+    def __init__(self) -> None:
+        global REPOSITORIES
+        REPOSITORIES = RepositoryCache()
+
+        self.parser = make_parser()
+        self._answers: dict[tuple, tuple[int, str]] = {}
+        # handlers print to the process stdout, so the queries are serialized
+        self._lock = threading.Lock()
+
+    def _key(self, argv: list[str], args: argparse.Namespace) -> tuple | None:
+        try:
+            stream = altcos.Stream.from_str(args.repo_root, args.stream)
+        except ValueError:
+            return None
+
+        today = datetime.datetime.now().strftime("%Y%m%d")
+        return tuple(argv), RepositoryCache.stamp(stream, args.mode), today
+
+    def query(self, argv: list[str]) -> tuple[int, str]:
+        with self._lock:
+            output = io.StringIO()
+            streams = [h.setStream(output) for h in logger.handlers]
+            returncode = 0
+            key = None
+
+            try:
+                with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                    try:
+                        args = self.parser.parse_args(argv)
+
+                        key = self._key(argv, args)
+                        if key is not None and (answer := self._answers.get(key)):
+                            return answer
+
+                        args.handle(args)
+                    except SystemExit as e:
+                        returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+                    except Exception as e:
+                        logger.fatal(e)
+                        returncode = 1
+            finally:
+                for handler, stream in zip(logger.handlers, streams):
+                    handler.setStream(stream)
+
+            answer = (returncode, output.getvalue())
+            if returncode == 0 and key is not None:
+                self._answers[key] = answer
+
+            return answer
+
+    def serve(self, path: pathlib.Path) -> None:
+        daemon = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                # every argument is NUL-terminated, only the last split is empty
+                argv = [a.decode() for a in self.rfile.read().split(b"\0")[:-1]]
+                returncode, output = daemon.query(argv)
+                self.wfile.write(f"{returncode}\n{output}".encode())
+
+        path.unlink(missing_ok=True)
+        with socketserver.ThreadingUnixStreamServer(str(path), RequestHandler) as server:
+            os.chmod(path, 0o600)
+            logger.info(f'serving on "{path}"')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                path.unlink(missing_ok=True)
+
+
+def default_socket() -> pathlib.Path:
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR", "/tmp")
+    return pathlib.Path(runtime_dir, f"altcos-stream-{os.getuid()}.sock")
+
+
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     StreamHandler.fill(parser)
 
@@ -164,11 +576,35 @@ def main() -> None:
 
     version = subparsers.add_parser("version")
     commit = subparsers.add_parser("commit")
+    describe = subparsers.add_parser("describe")
+    index = subparsers.add_parser("index")
+    history = subparsers.add_parser("history")
+    resolve = subparsers.add_parser("resolve")
 
     VersionHandler.fill(version)
     CommitHandler.fill(commit)
+    DescribeHandler.fill(describe)
+    IndexHandler.fill(index)
+    HistoryHandler.fill(history)
+    ResolveHandler.fill(resolve)
+
+    return parser
+
+
+def main() -> None:
+    if len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        parser = argparse.ArgumentParser(
+            prog=f"{sys.argv[0]} serve",
+            description="Serve the stream metadata queries on a UNIX socket "
+            "(the services use it through ALTCOS_STREAM_SOCKET)",
+        )
+        parser.add_argument("-s", "--socket", type=pathlib.Path, default=default_socket())
+        args = parser.parse_args(sys.argv[2:])
+
+        StreamDaemon().serve(args.socket)
+        return
 
-    args = parser.parse_args()
+    args = make_parser().parse_args()
 
     args.handle(args)
 